@@ -7,22 +7,41 @@ from tools.imageManagerUtils import settings
 # Python buildin modules
 import os
 import sys
-import subprocess
 import re
+import time
+import json
 import logging as logger
-from itertools import chain
+import fnmatch
+import posixpath
 from functools import partial
 
 # Utils designed for this script
-from tools.imageManagerUtils import sh
 from tools.imageManagerUtils import imageParser
-from tools.imageManagerUtils import mount
+from tools.imageManagerUtils import catalog
+from tools.imageManagerUtils import daemon
+# sh, mount and subprocess are slow to import. They are loaded by load_mount_utils()
+# only for the commands which run external programs.
+sh = None
+mount = None
+subprocess = None
+# The file system readers are loaded by load_reader_utils(), the records of the mount sessions by
+# load_session_utils(), only for the commands using them. Queries need none of them.
+fsReader = None
+manifest = None
+session = None
+
+# Time from loading settings to here, which is paid by every command including queries
+STARTUP_TIME = time.perf_counter() - settings.START_TIME
+# The default budget of STARTUP_TIME checked by --print-startup-timing
+STARTUP_BUDGET_MS = float(os.environ.get('IMAGE_MANAGER_STARTUP_BUDGET_MS', 50))
 
 # Define global variables
 SCRIPT_PATH = os.path.dirname(os.path.abspath(sys.argv[0]))
 IMAGE_DIR = os.environ.get('IMAGE_DIR')
-# The name of ROOTFS_DIR must be .rootfs for safety.
+# The name of ROOTFS_DIR must be .rootfs for safety. Each image is mounted onto a folder in it.
 ROOTFS_DIR = os.path.join(IMAGE_DIR, '.rootfs')
+# Commands which never change the image. They mount it read-only and never write it back.
+READ_ONLY_COMMANDS = ['ls', 'cat', 'file', 'pull']
 
 FORMAT = '{}[%(levelname)s]{} {}%(filename)s:%(lineno)d{} %(message)s'.format(
     '\033[1;31m',    # Red
@@ -33,6 +52,24 @@ FORMAT = '{}[%(levelname)s]{} {}%(filename)s:%(lineno)d{} %(message)s'.format(
 
 
 # ================ Util Functions ================
+def load_mount_utils():
+    global sh, mount, subprocess
+    import subprocess
+    from tools.imageManagerUtils import sh
+    from tools.imageManagerUtils import mount
+
+
+def load_reader_utils():
+    global fsReader, manifest
+    from tools.imageManagerUtils import fsReader
+    from tools.imageManagerUtils import manifest
+
+
+def load_session_utils():
+    global session
+    from tools.imageManagerUtils import session
+
+
 def check_input_image_format(arg):
     if arg is None or '@' not in arg:
         logger.error('image format error')
@@ -51,19 +88,27 @@ def inform_user_sudo(mesg=''):
 
 
 def parse_image(image_with_dir):
+    path = imageParser.locate_image_path(image_with_dir.split('@')[0])
+    with catalog.ImageCatalog() as image_catalog:
+        entry = image_catalog.lookup(path)
+    return make_image(path, '/'.join(image_with_dir.split('@')[1:]), entry)
+
+
+def make_image(path, target_path, entry):
     image = {}
-    image['path'] = imageParser.locate_image_path(image_with_dir.split('@')[0])
-    image['targetPath'] = '/'.join(image_with_dir.split('@')[1:])
+    image['path'] = path
     # Removing the leading slash
-    image['targetPath'] = image['targetPath'][1:]
-    image['type'] = imageParser.parse_image_type(image['path'])
+    image['targetPath'] = target_path[1:]
+    image['type'] = entry['type']
+    # Compressed CPIO images are decompressed and compressed again with the same options
+    image['compression'] = entry['compression']
     if image['type'] == 'MBR':
         if len(image['targetPath'].split('/')) >= 2:
             image['targetPartition'] = int(image['targetPath'].split('/')[0][1:])
             # Set with default '/'
             image['targetPath'] = '/'.join(image['targetPath'].split('/')[1:])
         # Set up partition table
-        image['partitionTable'] = imageParser.parse_partition_table(image['path'])
+        image['partitionTable'] = entry['partitionTable']
     return image
 
 
@@ -80,6 +125,17 @@ def remove_control_chars(text):
     return text.translate(mpa)
 
 
+def parse_jobs(argv):
+    # Read "--jobs N" or "-j N" out of argv, raise ValueError on bad numbers
+    for opt in ['--jobs', '-j']:
+        if opt in argv:
+            value = argv[argv.index(opt) + 1:][:1]
+            if not value or not value[0].isdigit() or int(value[0]) < 1:
+                raise ValueError('{} needs a positive number'.format(opt))
+            return int(value[0])
+    return catalog.DEFAULT_JOBS
+
+
 def find_ownership(path):
     dir_path = os.path.dirname(path)
     ret = subprocess.check_output('sudo stat -c "%u:%g" {}'.format(dir_path), shell=True)
@@ -89,36 +145,67 @@ def find_ownership(path):
 # ============= End of Util Functions ============
 
 
-def find_image_list():
-    def generate_type_list(a_list):
-        b_list = [['-name', name, '-o'] for name in a_list]
-        # Flatten the list and take out the last '-o'
-        return list(chain.from_iterable(b_list))[:-1]
-
-    black_list = ['rootfs', 'bootfs', 'linux*', 'build*', '*.fs']
+def walk_image_candidates():
+    """Yield the paths under IMAGE_DIR named like images, pruning while walking."""
+    # Mounted sessions (.rootfs, .loops) and caches are never searched for images
+    black_list = ['rootfs', 'bootfs', 'linux*', 'build*', '*.fs', '.rootfs', '.loops', '.cache']
     white_list = ['*.ext[1-5]', '*.cpio', '*.dd', '*.image', '*.img']
 
-    opt_b = [*'-type d'.split(), '(', generate_type_list(black_list), ')']
-    opt_w = [*'( -type l -o -type f )'.split(), '(', generate_type_list(white_list), ')']
-
-    logger.debug(opt_b)
-    logger.debug(opt_w)
-
-    sh.cd(IMAGE_DIR)
-    img_list = []
-    exec_opt = ['-exec', 'file', '-L', '{}', ';']
-    img_list = sh.find(*opt_b, '-prune', '-o', *opt_w, *exec_opt, _tty_out=False)
-    # Remove empty string and strip the first two characters "./"
-    img_list = [remove_control_chars(file_name)[2:] for file_name in img_list if file_name]
-    # Filter out images with broken symbolic link
-    img_list = [text for text in img_list if 'cannot open' not in text]
-    # Cut the string into two folds. [NAME: TYPE]
-    img_list = [[text.split(':')[0], ''.join(text.split(':')[1:])] for text in img_list]
-    # Transform into dictionary and parse type string
-    img_list = [{'name': kv[0], 'type': imageParser.get_type(kv[1])} for kv in img_list]
-    logger.debug(img_list)
-
-    return img_list
+    def match_any(name, patterns):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    for root, dirs, files in os.walk(IMAGE_DIR):
+        # Prune black-listed folders in place, same as "find -prune"
+        dirs[:] = sorted(d for d in dirs if not match_any(d, black_list))
+        for name in sorted(files):
+            if match_any(name, white_list):
+                yield os.path.join(root, name)
+
+
+def iter_image_list(image_catalog, jobs=catalog.DEFAULT_JOBS):
+    """Yield the images under IMAGE_DIR one by one, as soon as each is classified."""
+    candidates = set()
+
+    def record(paths):
+        for path in paths:
+            candidates.add(path)
+            yield path
+
+    for path, entry in image_catalog.lookup_all(record(walk_image_candidates()), jobs):
+        # Filter out images with broken symbolic link
+        if entry is None:
+            continue
+        yield {
+            'name': os.path.relpath(path, IMAGE_DIR),
+            'type': entry['type'],
+            # Apparent size and the size of allocated blocks, which is smaller for sparse images
+            'size': entry['size'],
+            'allocated': entry['blocks'] * 512,
+        }
+    # Only reached when the whole tree has been listed
+    image_catalog.prune(IMAGE_DIR, candidates)
+
+
+def run_in_process(image, command, argv):
+    """Run a read-only command without mounting. Return False when it is not supported."""
+    load_reader_utils()
+    load_session_utils()
+    if command not in fsReader.COMMANDS:
+        return False
+    if session.find(image['path'], writable=True) is not None:
+        # The image is mounted by a session, which could hold changes not written to it yet
+        return False
+    # ls is served from the manifest of the image when an up to date one is cached
+    image_fs = manifest.load(image, build_missing=False) if command == 'ls' else None
+    image_fs = image_fs or fsReader.open_filesystem(image)
+    if image_fs is None:
+        return False
+    with image_fs as fs:
+        try:
+            return fsReader.run_command(fs, command, image['targetPath'], argv)
+        except OSError as e:
+            logger.error('Fail to execute command: ' + str(e))
+            exit(1)
 
 
 def do_single_arg_cmd(argv, command, extra_argv=[]):
@@ -132,9 +219,11 @@ def do_single_arg_cmd(argv, command, extra_argv=[]):
     check_input_image_format(command_argv[0])
     image = parse_image(command_argv[0])
     logger.debug(image)
+    if run_in_process(image, command, extended_argv):
+        return
 
     inform_user_sudo('Need sudo to unfold/mount')
-    with mount.AutoMount(image) as m:
+    with mount.AutoMount(image, read_only=command in READ_ONLY_COMMANDS) as m:
         path = os.path.join(m.mount_point, image['targetPath'])
         try:
             sh.sudo(command, path, *extra_argv, *extended_argv, _fg=True)
@@ -144,12 +233,21 @@ def do_single_arg_cmd(argv, command, extra_argv=[]):
 
 
 def do_list(argv, extra_argv=[]):
-    image_list = find_image_list()
-    print('{:<40}{:<20}{:<20}'.format('IMAGE NAME', 'TYPE', 'SIZE'))
-    for image in image_list:
-        image_size_text = sh.du('-L', '-h', image['name'], _ok_code=range(255))
-        image['sizeB'] = image_size_text.split()[0]
-        print('{:<40}{:<20}{:<20}'.format(image['name'], image['type'], image['sizeB']))
+    try:
+        jobs = parse_jobs(argv)
+    except ValueError as e:
+        logger.error(str(e))
+        exit(1)
+    with catalog.ImageCatalog() as image_catalog:
+        image_list = iter_image_list(image_catalog, jobs)
+        if '-S' in argv or '--sort-size' in argv:
+            # Largest first, as "ls -S". Sorting needs the whole list before printing.
+            image_list = sorted(image_list, key=lambda image: image['size'], reverse=True)
+        print('{:<40}{:<20}{:<12}{:<12}'.format('IMAGE NAME', 'TYPE', 'SIZE', 'ALLOCATED'))
+        for image in image_list:
+            size = catalog.human_readable_size(image['size'])
+            allocated = catalog.human_readable_size(image['allocated'])
+            print('{:<40}{:<20}{:<12}{:<12}'.format(image['name'], image['type'], size, allocated))
 
 
 def do_push(argv, extra_argv=[]):
@@ -164,19 +262,44 @@ def do_push(argv, extra_argv=[]):
     check_input_image_format(image_file)
     image = parse_image(image_file)
     logger.debug(image)
+    if image['type'] == 'CPIO':
+        load_reader_utils()
+        load_session_utils()
+        # A session could be opened on the image meanwhile, it would not see the appended files
+        with session.ImageLock(session.image_key(image)):
+            try:
+                # Append to the archive in place instead of unpacking and packing it again
+                if (session.find(image['path'], writable=True) is None and
+                        fsReader.push_cpio(image, host_file)):
+                    return
+            except OSError as e:
+                logger.error('Fail to execute command: ' + str(e))
+                exit(1)
 
     inform_user_sudo('Need sudo to unfold/mount')
     with mount.AutoMount(image) as m:
         path = os.path.join(m.mount_point, image['targetPath'])
         try:
-            ownership = find_ownership(path)
-            logger.debug(host_file, path, ownership)
-            sh.sudo.rsync('-a', '-o', '-g', '--chown=' + ownership, host_file, path, _fg=True)
+            push_into(host_file, path)
         except sh.ErrorReturnCode:
             logger.error('Fail to execute command')
             exit(1)
 
 
+def push_into(host_file, path):
+    """Copy host_file to path in a mounted image, owned as the folder it is copied into."""
+    ownership = find_ownership(path)
+    logger.debug(host_file, path, ownership)
+    sh.sudo.rsync('-a', '-o', '-g', '--chown=' + ownership, host_file, path, _fg=True)
+
+
+def pull_from(path, host_file):
+    """Copy path in a mounted image to host_file, owned as the folder it is copied into."""
+    ownership = find_ownership(host_file)
+    logger.debug(path, host_file, ownership)
+    sh.sudo.rsync('-a', '-o', '-g', '--chown=' + ownership, path, host_file, _fg=True)
+
+
 def do_pull(argv, extra_argv=[]):
     command_argv, extended_argv = cut_argv(argv, 2)
     if len(command_argv) != 2:
@@ -189,56 +312,313 @@ def do_pull(argv, extra_argv=[]):
     check_input_image_format(image_file)
     image = parse_image(image_file)
     logger.debug(image)
+    if run_in_process(image, 'pull', [host_file]):
+        return
 
     inform_user_sudo('Need sudo to unfold/mount')
-    with mount.AutoMount(image) as m:
+    with mount.AutoMount(image, read_only=True) as m:
         path = os.path.join(m.mount_point, image['targetPath'])
         try:
-            ownership = find_ownership(host_file)
-            logger.debug(path, host_file, ownership)
-            sh.sudo.rsync('-a', '-o', '-g', '--chown=' + ownership, path, host_file, _fg=True)
+            pull_from(path, host_file)
         except sh.ErrorReturnCode:
             logger.error('Fail to execute command')
             exit(1)
 
 
-def do_query(argv, extra_argv=[]):
-    subcommand = argv.pop(0)
+def do_apply(argv):
+    if len(argv) != 2:
+        logger.error('Number of arguments is not enough')
+        exit(1)
+    check_input_image_format(argv[0])
+    image = parse_image(argv[0])
+    logger.debug(image)
+    from tools.imageManagerUtils import transaction
+    try:
+        # Every operation is checked before the image is mounted
+        operations = transaction.load(argv[1])
+    except (OSError, ValueError) as e:
+        logger.error(str(e))
+        exit(1)
+
+    inform_user_sudo('Need sudo to unfold/mount')
+    # One mount for all the operations, the image is written back once
+    read_only = all(operation['name'] in READ_ONLY_COMMANDS for operation in operations)
+    with mount.AutoMount(image, read_only=read_only) as m:
+        base = os.path.join(m.mount_point, image['targetPath'])
+        for operation in operations:
+            try:
+                run_operation(operation, partial(transaction.resolve, m.mount_point, base))
+            except (ValueError, sh.ErrorReturnCode) as e:
+                # The operations before stay applied, as running the commands one by one
+                logger.error('Fail to apply {}: {}'.format(operation['where'],
+                                                           ' '.join(operation['words'])))
+                if isinstance(e, ValueError):
+                    logger.error(str(e))
+                exit(1)
+
+
+def run_operation(operation, resolve):
+    name, options, args = operation['name'], operation['options'], operation['args']
+    logger.debug('{}: {}'.format(operation['where'], operation['words']))
+    if name == 'push':
+        push_into(args[0], resolve(args[1]))
+    elif name == 'pull':
+        pull_from(resolve(args[0]), args[1])
+    elif name == 'symlink':
+        sh.sudo.ln('-s', args[0], resolve(args[1]), _fg=True)
+    elif name == 'chmod':
+        sh.sudo.chmod(*options, args[0], *[resolve(path) for path in args[1:]], _fg=True)
+    else:
+        sh.sudo(name, *options, *[resolve(path) for path in args], _fg=True)
+
+
+class QueryError(Exception):
+    pass
+
+
+def complete_image_path(word, image_catalog):
+    """Return the completions of a partial "<IMAGE>@/<PATH>", served from the manifest."""
+    if '@' not in word:
+        raise QueryError('Missing image@/path of query command: complete')
+    name, target = word.split('@', 1)
+    path = name if os.path.isfile(name) else os.path.join(IMAGE_DIR, name)
+    entry = image_catalog.lookup(path)
+    if entry is None:
+        raise QueryError('Target image not found ' + path)
+    dir_path, prefix = posixpath.split(target.lstrip('/'))
+    base = '{}@/{}'.format(name, dir_path + '/' if dir_path else '')
+    if entry['type'] == 'MBR' and not dir_path:
+        # Still typing the partition, e.g. "p1"
+        partitions = (entry['partitionTable'] or {'partitions': []})['partitions']
+        names = ['p{}/'.format(part['number']) for part in partitions if part['mountable']]
+        return [base + n for n in names if n.startswith(prefix)]
+    try:
+        image = make_image(os.path.abspath(path), '/' + dir_path + '/', entry)
+    except ValueError:
+        # Not a partition, e.g. "px/"
+        return []
+    load_reader_utils()
+    tree = manifest.load(image)
+    if tree is None:
+        return []
+    return [base + n for n in tree.complete(image['targetPath'], prefix)]
+
+
+def run_query(subcommand, argv, image_catalog, stream=False):
+    """Answer a query with python data. Shared by do_query and the query daemon.
+
+    With stream=True, lists are returned as generators which yield each image as
+    soon as it is classified.
+    """
     # Match any of command, i.e. *of, e.g. typeof.
     if re.match(r'^\w+of$', subcommand):
+        if len(argv) == 0:
+            raise QueryError('Missing image of query command: ' + subcommand)
         if os.path.isfile(argv[0]):
             path = argv[0]
         else:
             path = os.path.join(IMAGE_DIR, argv[0])
 
-    if subcommand == 'list':
-        image_list = find_image_list()
-        for image in image_list:
-            print(image['name'])
-    elif subcommand == 'listWithType':
-        image_list = find_image_list()
-        for image in image_list:
-            print('{} {}'.format(
-                image['name'],
-                image['type'],
-            ))
+    if subcommand in ['list', 'listWithType']:
+        try:
+            image_list = iter_image_list(image_catalog, parse_jobs(argv))
+        except ValueError as e:
+            raise QueryError(str(e))
+        if subcommand == 'list':
+            result = (image['name'] for image in image_list)
+        else:
+            result = ([image['name'], image['type']] for image in image_list)
+        return result if stream else list(result)
     elif subcommand == 'typeof':
-        print(imageParser.parse_image_type(path))
+        entry = image_catalog.lookup(path)
+        return entry['type'] if entry else ''
+    elif subcommand == 'variantof':
+        entry = image_catalog.lookup(path)
+        if entry is None:
+            return None
+        # Variant first, followed by the feature flags, e.g. "ext4 has_journal extent"
+        return ' '.join([entry['variant'], *entry['features']])
+    elif subcommand == 'compressionof':
+        entry = image_catalog.lookup(path)
+        # Codec of compressed CPIO images, e.g. "gzip", or empty
+        return entry['compression']['codec'] if entry and entry['compression'] else ''
     elif subcommand == 'sizeof':
-        image_size_text = sh.du('-L', '-h', path, _ok_code=range(255))
-        print(image_size_text.split()[0])
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise QueryError('Target image not found ' + path)
+        return {'size': st.st_size, 'allocated': st.st_blocks * 512}
     elif subcommand == 'pathof':
-        print(imageParser.locate_image_path(path))
+        if not os.path.isfile(path):
+            raise QueryError('Target image not found ' + path)
+        return os.path.abspath(path)
+    elif subcommand == 'complete':
+        return complete_image_path(argv[0] if argv else '', image_catalog)
     elif subcommand == 'partitionTableof':
-        path = imageParser.locate_image_path(path)
-        img = imageParser.parse_partition_table(path)
-        for idx, part in enumerate(img['partitions']):
-            # index, start, end, size, offset, sizelimit, mountable
-            print('{} {} {} {} {} {} {}'.format(idx + 1, part['start'], part['end'], part['size'],
-                                                part['offset'], part['sizelimit'],
-                                                part['mountable']))
+        entry = image_catalog.lookup(path)
+        if entry is None:
+            raise QueryError('Target image not found ' + path)
+        img = entry['partitionTable'] or {'partitions': []}
+        return img['partitions']
+    raise QueryError('Query command not supported: ' + str(subcommand))
+
+
+def format_query_result(subcommand, result):
+    if result is None:
+        return []
+    if subcommand in ['list', 'complete']:
+        return result
+    elif subcommand == 'listWithType':
+        return ('{} {}'.format(name, image_type) for name, image_type in result)
+    elif subcommand == 'partitionTableof':
+        # number, start, end, size, offset, sizelimit, mountable
+        return [
+            '{} {} {} {} {} {} {}'.format(part['number'], part['start'], part['end'], part['size'],
+                                          part['offset'], part['sizelimit'], part['mountable'])
+            for part in result
+        ]
+    elif subcommand == 'sizeof':
+        # Allocated size, as "du -L -h" used to print
+        return [catalog.human_readable_size(result['allocated'])]
+    return [result]
+
+
+def absolute_query_argv(argv):
+    # The daemon does not share our working directory, send it absolute paths
+    return [os.path.abspath(arg) if os.path.isfile(arg) else arg for arg in argv]
+
+
+def do_query_batch():
+    # Answer '<subcommand> <image>' lines from stdin with one JSON object per line
+    use_daemon = True
+    image_catalog = None
+    for line in sys.stdin:
+        words = line.split(None, 1)
+        if not words:
+            continue
+        subcommand = words[0]
+        # Image names could contain spaces, take the rest of the line as it is
+        argv = absolute_query_argv([w.strip() for w in words[1:]])
+        response = None
+        if use_daemon:
+            # One connection per request, none is held while waiting on stdin
+            response = daemon.request({'query': subcommand, 'args': argv})
+        if response is None:
+            # Keep answering in this process once the daemon is gone
+            use_daemon = False
+            if image_catalog is None:
+                image_catalog = catalog.ImageCatalog()
+            try:
+                response = {'result': run_query(subcommand, argv, image_catalog)}
+            except QueryError as e:
+                response = {'error': str(e)}
+        response = dict(query=subcommand, args=argv, **response)
+        # Flush every answer so that callers can consume them as a pipeline
+        print(json.dumps(response), flush=True)
+    if image_catalog is not None:
+        image_catalog.save()
+
+
+def do_query(argv, extra_argv=[]):
+    subcommand = argv.pop(0)
+    if subcommand == '--batch':
+        do_query_batch()
+        return
+    request_argv = absolute_query_argv(argv)
+    response = daemon.request({'query': subcommand, 'args': request_argv})
+    if response is None:
+        # No daemon is serving IMAGE_DIR, answer the query in this process
+        with catalog.ImageCatalog() as image_catalog:
+            try:
+                result = run_query(subcommand, argv, image_catalog, stream=True)
+            except QueryError as e:
+                logger.error(str(e))
+                exit(1)
+            for line in format_query_result(subcommand, result):
+                print(line)
+        return
+    elif 'error' in response:
+        logger.error(response['error'])
+        exit(1)
     else:
-        logger.error('Query command not supported: ' + str(subcommand))
+        result = response['result']
+    for line in format_query_result(subcommand, result):
+        print(line)
+
+
+def do_serve(argv, extra_argv=[]):
+    image_catalog = catalog.ImageCatalog()
+
+    def handle_request(message):
+        try:
+            result = run_query(message['query'], message['args'], image_catalog)
+        except QueryError as e:
+            return {'error': str(e)}
+        finally:
+            image_catalog.save()
+        return {'result': result}
+
+    daemon.serve(handle_request)
+
+
+def do_compact(argv):
+    if len(argv) != 1:
+        logger.error('Number of arguments is not enough')
+        exit(1)
+    image = parse_image(argv[0])
+    if image['type'] != 'CPIO':
+        logger.error('Only CPIO images can be compacted')
+        exit(1)
+    load_reader_utils()
+    load_session_utils()
+    if session.find(image['path']) is not None:
+        # Write the changes in the unpacked image back first
+        load_mount_utils()
+        inform_user_sudo('Need sudo to pack the image')
+        mount.flush_sessions(image['path'])
+    with session.ImageLock(session.image_key(image)):
+        if session.find(image['path']) is not None:
+            logger.error('Image is in use, try again later')
+            exit(1)
+        try:
+            before, after = fsReader.compact_cpio(image)
+        except OSError as e:
+            logger.error('Fail to compact image: ' + str(e))
+            exit(1)
+    print('{}: {} -> {}'.format(argv[0], catalog.human_readable_size(before),
+                                catalog.human_readable_size(after)))
+
+
+def do_flush(argv):
+    if argv[:1] == ['--idle']:
+        # Started by AutoMount to close the sessions once they are idle
+        load_mount_utils()
+        mount.reap_idle_sessions()
+        return
+    image_path = imageParser.locate_image_path(argv[0]) if argv else None
+    load_session_utils()
+    sessions = session.read_sessions().get('sessions', {}).values()
+    if [record for record in sessions if session.same_image(image_path, record['image'])]:
+        load_mount_utils()
+        inform_user_sudo('Need sudo to pack/unmount')
+        for path in mount.flush_sessions(image_path):
+            print('Flushed ' + os.path.relpath(path, IMAGE_DIR))
+    # Sessions closed by children of earlier commands are written back once they end
+    report_failed_jobs(session.wait_jobs(image_path, forget_failed=True))
+
+
+def do_wait(argv):
+    image_path = imageParser.locate_image_path(argv[0]) if argv else None
+    load_session_utils()
+    report_failed_jobs(session.wait_jobs(image_path, forget_failed=True))
+
+
+def report_failed_jobs(jobs):
+    for job in jobs:
+        logger.error('Fail to {} {} (PID {})'.format(job['action'],
+                                                     os.path.relpath(job['image'], IMAGE_DIR),
+                                                     job['pid']))
+    if jobs:
         exit(1)
 
 
@@ -259,6 +639,26 @@ def do_umount(argv, user=False):
     mount.autounmount(image, argv[1], user)
 
 
+def print_startup_timing():
+    settings.print_startup_timing()
+    # Modules which must never be loaded before dispatching a command
+    heavy_modules = ['tools.imageManagerUtils.' + name for name in [
+        'sh', 'mount', 'fsReader', 'manifest', 'session', 'transaction', 'compression']]
+    preloaded = [name for name in heavy_modules if name in sys.modules]
+    start = time.perf_counter()
+    load_mount_utils()
+    load_time = time.perf_counter() - start
+    print('Startup (queries) : {:8.3f} ms (budget {:.3f} ms)'.format(STARTUP_TIME * 1000,
+                                                                   STARTUP_BUDGET_MS))
+    print('Load sh and mount : {:8.3f} ms'.format(load_time * 1000))
+    if preloaded:
+        logger.error('Modules loaded at startup: ' + ', '.join(preloaded))
+        exit(1)
+    if STARTUP_TIME * 1000 > STARTUP_BUDGET_MS:
+        logger.error('Startup time exceeds the budget')
+        exit(1)
+
+
 def print_help():
     print('''
 Usage:
@@ -266,7 +666,9 @@ Usage:
   Do something with disk images for simulation.
 
 TYPE - 0: Information from outside
-       list      : List all existing images
+       list [-S|--sort-size] [-j|--jobs N]
+                 : List all existing images with their apparent and allocated
+                   sizes, optionally largest first. Probe N images at a time.
 
 TYPE - 1: Do <OP> in image
        <OP>  <IMAGE>@/[PART]/<PATH> [OPTIONS...]
@@ -281,18 +683,58 @@ TYPE - 1: Do <OP> in image
 TYPE - 2:
        push  <PATH> <IMAGE>@/<PATH>  : Push a file/folder into image
        pull  <IMAGE>@/<PATH> <PATH>  : Pull a file/folder from image
+       compact <IMAGE>               : Drop the files replaced by pushes from a CPIO image
+       apply <IMAGE>@/<PATH> <FILE>  : Run the operations listed in FILE (- for stdin) in
+                                       one mount of the image, paths relative to <PATH>
+       flush [IMAGE]                 : Write back and unmount the images kept mounted
+       wait [IMAGE]                  : Wait for the unmounts and mounts left running
+
+       Pushing into a CPIO image appends the files to the archive, the
+       replaced copies stay in the image until it is compacted.
+       The operations of apply are push, pull, rm, mkdir, chmod and symlink,
+       one per line as their arguments on the command line, e.g.
+           mkdir -p /etc/init.d
+           push ./rcS /etc/init.d
+           chmod 755 /etc/init.d/rcS
+           symlink /bin/busybox /sbin/init
+       or a JSON (YAML with PyYAML) list of them, see transaction.py. They
+       are all checked first, and stop at the first one failing.
+       Images mounted (or CPIO images unpacked) by commands stay mounted for
+       the following commands until they are unused for $IMAGE_SESSION_TIMEOUT
+       seconds (default: 60, 0 unmounts them in the background as soon as the
+       command returns, see wait). Changes to CPIO images are written back
+       then, or by flush. Each image has a mount point of its own, commands on
+       different images can run in parallel. The commands only reading images
+       (ls, cat, file, pull) mount them read-only and never write them back.
 
 TYPE - 3:
        query <TYPE> <IMAGE>
+       query --batch
 
        where <TYPE> can be:
-           list, typeof, sizeof, pathof, partitionTableof
+           list [--jobs N], typeof, variantof, compressionof, sizeof, pathof,
+           partitionTableof
+       query complete <IMAGE>@/[PART]/<PATH> prints the paths in the image
+       starting with <PATH>, folders ending with a slash, for shell completion.
+       They are read from a manifest of the image, cached until it changes.
+       With --batch, read "<TYPE> <IMAGE>" lines from stdin and print one
+       JSON object per line, e.g. {"query": "typeof", "args": [...], "result": "MBR"}
+
+       serve : Keep the image catalog in memory and answer queries over
+               IMAGE_DIR/.cache/imageManager.sock. Queries run in-process
+               when no daemon is running.
 
 TYPE - 4:
        mount <IMAGE> <MOUNT POINT ROOT> [-F]
        umount <IMAGE> <MOUNT POINT ROOT>
 
        Option "-F" means fork. Execute commands in a non-blocking fashion.
+       "wait" returns once the forked commands are done, and fails if any of
+       them failed. Later mounts onto the same folder wait for them as well.
+
+OTHERS:
+       --print-startup-timing : Show the startup time and check it against the budget
+                                set by $IMAGE_MANAGER_STARTUP_BUDGET_MS (default: 50)
 
 '''.format(sys.argv[0], sys.argv[0]))
 
@@ -303,11 +745,14 @@ def main(argv):
         exit(1)
 
     # Create ROOTFS_DIR if not present
-    sh.mkdir(ROOTFS_DIR, "-p")
+    os.makedirs(ROOTFS_DIR, exist_ok=True)
 
     if len(argv) == 0 or argv[0] == '-h' or argv[0] == '--help':
         print_help()
         exit(0)
+    if argv[0] == '--print-startup-timing':
+        print_startup_timing()
+        exit(0)
     allowed_cmds = ['ls', 'rm', 'mkdir', 'file', 'vim', 'nano', 'cat']
 
     actions = {
@@ -315,14 +760,24 @@ def main(argv):
         'push': do_push,
         'pull': do_pull,
         'query': do_query,
+        'serve': do_serve,
+        'compact': do_compact,
+        'apply': do_apply,
+        'flush': do_flush,
+        'wait': do_wait,
         'mount': do_mount,
         'umount': do_umount,
         'userMount': partial(do_mount, user=True),
         'userUmount': partial(do_umount, user=True),
     }
 
+    # These commands only read image metadata and run with the standard modules
+    metadata_actions = ['list', 'query', 'serve', 'compact', 'flush', 'wait']
+
     # Remove one element from argument list
     command = argv.pop(0)
+    if command not in metadata_actions:
+        load_mount_utils()
     if command in actions.keys():
         actions[command](argv)
     elif command in allowed_cmds:
@@ -173,6 +173,9 @@ QEMU=$(get_run_script "$image_path")
 [[ -z "$QEMU" ]] && QEMU=$(get_run_script "${IMAGE_DIR}/${image_path}")
 [[ -z "$QEMU" ]] && echo "Cannot find script runQEMU.sh in '$image_path'" && exit 1
 
+# Write back and unmount the images kept mounted by imageManager, QEMU must not share them
+"${SCRIPT_PATH}/imageManager.py" flush || exit 1
+
 # Execute QEMU
 echo -e "Running '${COLOR_GREEN}${QEMU} ${QEMU_ARGS[@]}${NC}'"
 $QEMU "${QEMU_ARGS[@]}"
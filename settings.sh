@@ -10,3 +10,7 @@ export IMAGE_DIR="$AXIOM_HOME/guest-images"
 export ROOTFS_DIR="$(readlink -f "${IMAGE_DIR}/.rootfs")"
 export VIRT_ROOT_DIR="${AXIOM_HOME}/external/virt-root"
 export RUN_QEMU_SCRIPT_PATH="${AXIOM_HOME}"
+
+# Seconds the images mounted by imageManager are kept mounted for the following commands.
+# 0 unmounts them as soon as a command ends.
+# export IMAGE_SESSION_TIMEOUT=60
@@ -41,28 +41,6 @@ function _complete_runQEMU() {
     esac
 }
 
-function _complete_image_file_path() {
-    local image_name="$1"
-    local cur="$2"
-    local opts=""
-    local realcur="${cur##*/}"
-    local prefix="${cur%$realcur}"
-
-    # Extract the directory path out of incomplete path
-    local dir_path="$axiom_comp_rootfs/$cur"
-    [[ ! -d "$dir_path" ]] && dir_path="$(dirname "$dir_path")"
-    local file_lists=( $(ls "$dir_path") )
-
-    for w in "${file_lists[@]}"; do
-        if ! [[ $prefix == *"$w"* ]]; then
-            opts="$w $opts"
-        fi
-    done
-
-    COMPREPLY=( $(compgen -W "$opts" -S '/' -- $cur) )
-    COMPREPLY=( $(compgen -P "$image_name@/$prefix" -W "$opts" -S '/' -- $realcur) )
-}
-
 function _complete_image_manager_path() {
     local cur prev image_list
     _get_comp_words_by_ref cur prev
@@ -70,14 +48,9 @@ function _complete_image_manager_path() {
     image_list="$axiom_image_list";
 
     if [[ "$cur" == *@/* ]]; then
-        # Complete path when typing after @
-        local image_name=${cur%%@/*}
-        local target_dir=${cur##*@/}
-
-        user_mount_image "$image_name"
-        if [[ -d "$axiom_comp_rootfs" ]]; then
-            _complete_image_file_path "$image_name" "$target_dir"
-        fi
+        # Complete path when typing after @, names could contain spaces
+        local IFS=$'\n'
+        COMPREPLY=( $(_get_image_paths "$cur") )
     else
         # Complete image when typing before @
         COMPREPLY=( $(compgen -W "${image_list}" -S "@/" -- ${cur}) )
@@ -96,7 +69,7 @@ function _complete_image_manager() {
         curr_arg_num=$(( $curr_arg_num - 1 ))
     fi
     local operation=${s_words[2]}
-    local options="-h --help list push pull ls rm mkdir file vim nano cat"
+    local options="-h --help list push pull apply compact flush wait ls rm mkdir file vim nano cat"
 
     if [[ $axiom_update_flag == 0 ]]; then
         #axiom_update_flag=1
@@ -114,6 +87,14 @@ function _complete_image_manager() {
             [[ $curr_arg_num == 3 ]] && _complete_image_manager_path
             [[ $curr_arg_num == 4 ]] && COMPREPLY=($(compgen -f "$cur_arg"))
             ;;
+        "apply")
+            compopt -o nospace
+            [[ $curr_arg_num == 3 ]] && _complete_image_manager_path
+            [[ $curr_arg_num == 4 ]] && COMPREPLY=($(compgen -f "$cur_arg"))
+            ;;
+        "compact" | "flush" | "wait")
+            [[ $curr_arg_num == 3 ]] && COMPREPLY=( $(compgen -W "${axiom_image_list}" -- $cur_arg) )
+            ;;
         "ls" | "rm" | "mkdir" | "file" | "vim" | "nano" | "cat")
             compopt -o nospace
             [[ $curr_arg_num == 3 ]] && _complete_image_manager_path
@@ -65,15 +65,9 @@ function _complete_image_and_path() {
         # Complete image when typing before @
         _sep_parts "($axiom_image_list)" @/
     else
-        # Complete path when typing after @
-        local image_name=${cur_arg%%@*}
-        local target_dir=${cur_arg##*@}
-
-        user_mount_image "$image_name"
-
-        if [[ -d "$axiom_comp_rootfs" ]] && compset -P '*@/'; then
-            _files -W "$axiom_comp_rootfs"
-        fi
+        # Complete path when typing after @, the candidates are whole words
+        local candidates=(${(f)"$(_get_image_paths "$cur_arg")"})
+        compadd -U -S '' -- "${candidates[@]}"
     fi
 }
 
@@ -95,6 +89,10 @@ function _complete_image_manager() {
     local actions=('list:List all existing images'
         'push:Push a file/folder into image'
         'pull:Pull a file/folder from image'
+        'apply:Run the operations listed in a file in one mount of image'
+        'compact:Drop the files replaced by pushes from a CPIO image'
+        'flush:Write back and unmount the images kept mounted'
+        'wait:Wait for the unmounts and mounts left running'
         'ls:List files in image folder'
         'rm:Remove file/folder from image'
         'mkdir:Make a folder in image'
@@ -113,6 +111,16 @@ function _complete_image_manager() {
             [[ $curr_arg_num == 3 ]] &&  _complete_image_and_path
             [[ $curr_arg_num == 4 ]] &&  _alternative 'files:filenames:_files'
             ;;
+        "apply")
+            [[ $curr_arg_num == 3 ]] &&  _complete_image_and_path
+            [[ $curr_arg_num == 4 ]] &&  _alternative 'files:filenames:_files'
+            ;;
+        "compact" | "flush" | "wait")
+            if [[ $curr_arg_num == 3 ]]; then
+                [[ $axiom_update_flag == 0 ]] && axiom_image_list=$(_get_image_list)
+                _sep_parts "($axiom_image_list)"
+            fi
+            ;;
         "ls" | "rm" | "mkdir" | "file" | "vim" | "nano" | "cat")
             [[ $curr_arg_num == 3 ]] &&  _complete_image_and_path
             ;;
@@ -0,0 +1,202 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file keeps a persistent catalog of the images under IMAGE_DIR.
+# Probing an image (type detection, partition table) is expensive compared
+# to a stat call, so the result of each probe is stored on disk together with
+# the inode, size and mtime of the image. An entry is probed again only when
+# its stat information no longer matches the recorded one.
+# Other per-image data, e.g. the index of a cpio archive, is cached the same
+# way under .cache/<kind>/, tagged with the fingerprint of the image.
+
+# Python buildin modules
+import os
+import json
+import math
+import stat
+import hashlib
+import tempfile
+import collections
+import logging as logger
+
+# Utils designed for this script
+from . import imageParser
+
+IMAGE_DIR = os.environ.get('IMAGE_DIR')
+CACHE_DIR = os.path.join(IMAGE_DIR, '.cache')
+CATALOG_PATH = os.path.join(CACHE_DIR, 'catalog.json')
+# Number of images probed concurrently by default
+DEFAULT_JOBS = 8
+# Bump this number whenever the format of an entry changes
+CATALOG_VERSION = 4
+
+
+def stat_key(st):
+    return {
+        'inode': st.st_ino,
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+    }
+
+
+def image_fingerprint(st):
+    # Any write to the image changes its size or mtime, a new file changes its inode
+    return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def human_readable_size(size):
+    # Same format as "ls -h" and "du -h": round up, with one decimal below 10, e.g. 4.0K, 1.2M
+    if size < 1024:
+        return str(size)
+    for unit in 'KMGTPE':
+        size /= 1024
+        if size < 10 and math.ceil(size * 10) < 100:
+            return '{:.1f}{}'.format(math.ceil(size * 10) / 10, unit)
+        if math.ceil(size) < 1024 or unit == 'E':
+            return '{}{}'.format(math.ceil(size), unit)
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def image_cache_path(kind, path):
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(CACHE_DIR, kind, name + '.json')
+
+
+def load_image_cache(kind, path, st, version=1):
+    """Return the cached data of kind for the image, or None when it is missing or outdated."""
+    try:
+        with open(image_cache_path(kind, path), 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('fingerprint') != image_fingerprint(st) or cache.get('version') != version:
+        return None
+    return cache.get('data')
+
+
+def save_image_cache(kind, path, st, data, version=1):
+    # One file per image, the cache of an older version of the image is overwritten
+    try:
+        write_json(image_cache_path(kind, path),
+                   {'version': version, 'fingerprint': image_fingerprint(st), 'data': data})
+    except OSError as e:
+        logger.debug('Cannot save {} cache of {}: {}'.format(kind, path, e))
+
+
+def probe_image(path, st):
+    entry = stat_key(st)
+    entry['blocks'] = st.st_blocks
+    info = imageParser.sniff_image(path)
+    entry['type'] = info['type']
+    entry['variant'] = info['variant']
+    entry['features'] = info['features']
+    entry['compression'] = info['compression']
+    entry['partitionTable'] = None
+    if entry['type'] == 'MBR':
+        entry['partitionTable'] = imageParser.parse_partition_table(path)
+    return entry
+
+
+class ImageCatalog():
+    def __init__(self, catalog_path=CATALOG_PATH):
+        self.catalog_path = catalog_path
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.catalog_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != CATALOG_VERSION:
+            logger.debug('Drop catalog with version ' + str(data.get('version')))
+            return
+        self.entries = data.get('images', {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {'version': CATALOG_VERSION, 'images': self.entries}
+        try:
+            write_json(self.catalog_path, data)
+            self.dirty = False
+        except OSError as e:
+            logger.debug('Cannot save image catalog: ' + str(e))
+
+    def check(self, path):
+        """Return (entry, changed) of path. Safe to call from worker threads."""
+        try:
+            # Follow symbolic links, as "file -L" did
+            st = os.stat(path)
+        except OSError:
+            return None, False
+        if not stat.S_ISREG(st.st_mode):
+            return None, False
+        entry = self.entries.get(path)
+        if entry is None or any(entry.get(k) != v for k, v in stat_key(st).items()):
+            logger.debug('Probe image ' + path)
+            return probe_image(path, st), True
+        return entry, False
+
+    def update(self, path, entry, changed):
+        if changed:
+            self.entries[path] = entry
+            self.dirty = True
+        return entry
+
+    def lookup(self, path):
+        """Return the catalog entry of path, or None when path is not a readable file."""
+        path = os.path.abspath(path)
+        return self.update(path, *self.check(path))
+
+    def lookup_all(self, paths, jobs=DEFAULT_JOBS):
+        """Look up many paths with up to jobs probes in flight. Yield (path, entry) in order."""
+        if jobs <= 1:
+            for path in paths:
+                yield path, self.lookup(path)
+            return
+        # Imported here to keep it out of the startup of single queries
+        from concurrent.futures import ThreadPoolExecutor
+        # Reading headers is dominated by I/O latency, threads overlap it well.
+        # Entries are only updated here, in the thread consuming the results.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = collections.deque()
+            for path in paths:
+                path = os.path.abspath(path)
+                pending.append((path, executor.submit(self.check, path)))
+                # Bound the number of queued probes
+                if len(pending) >= jobs * 2:
+                    path, future = pending.popleft()
+                    yield path, self.update(path, *future.result())
+            while pending:
+                path, future = pending.popleft()
+                yield path, self.update(path, *future.result())
+
+    def prune(self, root, valid_paths):
+        """Forget the entries under root which are not in valid_paths."""
+        root = os.path.join(os.path.abspath(root), '')
+        valid_paths = set(os.path.abspath(p) for p in valid_paths)
+        stale = [p for p in self.entries if p.startswith(root) and p not in valid_paths]
+        for p in stale:
+            del self.entries[p]
+        if stale:
+            self.dirty = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.save()
@@ -0,0 +1,264 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file handles compressed images, e.g. the initramfs compressed by the
+# kernel build with gzip, xz, zstd or lz4 (legacy format, as the kernel
+# expects). The codec is detected from the magic number and its options are
+# read from the header, so that an image is compressed again the same way.
+# The level is recorded by gzip (XFL) and derived from the dictionary size for
+# xz. zstd does not record it and is guessed from the window size.
+#
+# Data is streamed in both directions. Python modules are used when they are
+# available (gzip and lzma are standard, zstandard is optional), the command
+# line tools otherwise. Multithreaded tools (pigz, xz -T0, zstd -T0) are
+# preferred for compression.
+
+# Python buildin modules
+import shutil
+
+MAGICS = {
+    'gzip': b'\x1f\x8b',
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x02\x21\x4c\x18',
+}
+# Dictionary sizes of the xz presets 0 to 9
+XZ_PRESET_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22,
+                        1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+XZ_CHECKS = {0: 'none', 1: 'crc32', 4: 'crc64', 10: 'sha256'}
+# Window log of the zstd levels on large inputs, the highest level of each is taken
+ZSTD_WINDOW_LEVELS = {19: 1, 20: 2, 21: 3, 22: 16, 23: 19, 24: 19, 25: 20, 26: 21, 27: 22}
+ZSTD_DEFAULT_LEVEL = 3
+CHUNK_SIZE = 1 << 20
+
+
+def detect(header):
+    for codec, magic in MAGICS.items():
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        position += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def xz_options(header):
+    options = {'codec': 'xz', 'level': 6, 'check': 'crc64', 'dictSize': XZ_PRESET_DICT_SIZES[6]}
+    try:
+        # The kernel only verifies crc32 checks, keep the check of the image
+        options['check'] = XZ_CHECKS.get(header[7] & 0x0F, 'crc64')
+        # Stream header (12 bytes), then the header of the first block with the filter chain
+        flags = header[13]
+        position = 14
+        for present in [flags & 0x40, flags & 0x80]:
+            if present:
+                position = read_varint(header, position)[1]
+        for _ in range((flags & 0x03) + 1):
+            filter_id, position = read_varint(header, position)
+            props_size, position = read_varint(header, position)
+            if filter_id == 0x21:
+                # LZMA2, the dictionary size is encoded in a single byte
+                props = header[position]
+                options['dictSize'] = (2 | (props & 1)) << (props // 2 + 11)
+            position += props_size
+    except IndexError:
+        pass
+    # Presets 7 to 9 are preset 6 with a larger dictionary. Smaller dictionaries, like the 1 MiB
+    # of the kernel build, are preset 6 with the dictionary size given explicitly.
+    sizes = [i for i, size in enumerate(XZ_PRESET_DICT_SIZES) if size >= options['dictSize']]
+    options['level'] = max(6, sizes[0]) if sizes else 9
+    return options
+
+
+def zstd_options(header):
+    level = ZSTD_DEFAULT_LEVEL
+    if len(header) > 5 and not header[4] & 0x20:
+        # No single segment flag, the window descriptor follows
+        window_log = 10 + (header[5] >> 3)
+        level = ZSTD_WINDOW_LEVELS.get(window_log, 22 if window_log > 27 else ZSTD_DEFAULT_LEVEL)
+    return {'codec': 'zstd', 'level': level}
+
+
+def parse_options(header):
+    """Return the codec and the options to compress data as header does, or None."""
+    codec = detect(header)
+    if codec == 'gzip':
+        # XFL: 2 for the maximum compression, 4 for the fastest
+        level = {2: 9, 4: 1}.get(header[8] if len(header) > 8 else 0, 6)
+        return {'codec': 'gzip', 'level': level}
+    elif codec == 'xz':
+        return xz_options(header)
+    elif codec == 'zstd':
+        return zstd_options(header)
+    elif codec == 'lz4':
+        # Level of the kernel build, the legacy format does not record it
+        return {'codec': 'lz4', 'level': 9}
+    return None
+
+
+def detect_file(path, size=64):
+    with open(path, 'rb') as f:
+        return parse_options(f.read(size))
+
+
+def decompress_command(options):
+    """Return the shell command decompressing stdin to stdout."""
+    return '{} -d -c'.format(options['codec'])
+
+
+# ================ Decompression ================
+class ProcessReader():
+    """Read the standard output of a command like a file."""
+    def __init__(self, argv, stdin):
+        import subprocess
+        self.process = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.argv = argv
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self, check=False):
+        self.process.stdout.close()
+        if not check and self.process.poll() is None:
+            # The rest of the output is not needed
+            self.process.kill()
+        if self.process.wait() and check:
+            raise OSError('Command failed: ' + ' '.join(self.argv))
+
+
+def open_decompressed(f, options):
+    """Return a readable file object of the data decompressed from the file f."""
+    codec = options['codec']
+    if codec == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif codec == 'xz':
+        import lzma
+        return lzma.LZMAFile(f, 'rb')
+    if codec == 'zstd':
+        try:
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        except ImportError:
+            pass
+    if not shutil.which(codec):
+        raise OSError('Cannot find {} to decompress the image'.format(codec))
+    return ProcessReader([codec, '-d', '-c', '-q'], f)
+
+
+def read_head(path, options, size):
+    """Return the first size bytes of the data decompressed from path."""
+    with open(path, 'rb') as f:
+        reader = open_decompressed(f, options)
+        try:
+            return reader.read(size)
+        except (OSError, EOFError, ValueError):
+            return b''
+        finally:
+            reader.close()
+
+
+def decompress(path, options, out):
+    """Decompress path into the file out."""
+    with open(path, 'rb') as f:
+        reader = open_decompressed(f, options)
+        try:
+            shutil.copyfileobj(reader, out, CHUNK_SIZE)
+        except (EOFError, ValueError) as e:
+            raise OSError('Cannot decompress {}: {}'.format(path, e))
+        finally:
+            if isinstance(reader, ProcessReader):
+                reader.close(check=True)
+            else:
+                reader.close()
+
+
+# ================ Compression ================
+def compress_command(options):
+    """Return the command compressing stdin to stdout with options, or None to use Python."""
+    codec, level = options['codec'], options['level']
+    if codec == 'gzip' and shutil.which('pigz'):
+        # -n keeps the name and time out of the header, the output only depends on the data
+        return ['pigz', '-n', '-c', '-{}'.format(level)]
+    elif codec == 'xz' and shutil.which('xz'):
+        return ['xz', '-c', '-T0', '--check=' + options['check'],
+                '--lzma2=preset={},dict={}'.format(level, options['dictSize'])]
+    elif codec == 'zstd':
+        try:
+            import zstandard
+            return None
+        except ImportError:
+            pass
+        ultra = ['--ultra'] if level > 19 else []
+        return ['zstd', '-c', '-q', '-T0', '-{}'.format(level)] + ultra
+    elif codec == 'lz4':
+        return ['lz4', '-l', '-c', '-q', '-{}'.format(level)]
+    return None
+
+
+class ProcessWriter():
+    """Write to the standard input of a command like a file."""
+    def __init__(self, argv, stdout):
+        import subprocess
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=stdout)
+        self.argv = argv
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait():
+            raise OSError('Command failed: ' + ' '.join(self.argv))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def open_compressor(options, out):
+    """Return a writable file object compressing into the file out."""
+    codec, level = options['codec'], options['level']
+    argv = compress_command(options)
+    if argv is not None:
+        if not shutil.which(argv[0]):
+            raise OSError('Cannot find {} to compress the image'.format(argv[0]))
+        # The command writes to the file directly, after what is buffered here
+        out.flush()
+        return ProcessWriter(argv, out)
+    if codec == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0)
+    elif codec == 'xz':
+        import lzma
+        checks = {'none': lzma.CHECK_NONE, 'crc32': lzma.CHECK_CRC32,
+                  'crc64': lzma.CHECK_CRC64, 'sha256': lzma.CHECK_SHA256}
+        filters = [{'id': lzma.FILTER_LZMA2, 'preset': level, 'dict_size': options['dictSize']}]
+        return lzma.LZMAFile(out, 'wb', check=checks[options['check']], filters=filters)
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+    return compressor.stream_writer(out, closefd=False)
+
+
+def compress(options, src, out):
+    """Compress the file src, e.g. a pipe, into the file out."""
+    argv = compress_command(options)
+    if argv is not None and shutil.which(argv[0]):
+        import subprocess
+        # Let the command read src directly, nothing is copied by this process
+        out.flush()
+        if subprocess.call(argv, stdin=src, stdout=out):
+            raise OSError('Command failed: ' + ' '.join(argv))
+        return
+    with open_compressor(options, out) as writer:
+        shutil.copyfileobj(src, writer, CHUNK_SIZE)
@@ -0,0 +1,427 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file reads cpio archives (newc and odc formats, see "man 5 cpio")
+# without unpacking them. The headers are scanned once into an index of
+# path -> (mode, uid, gid, nlink, mtime, size, data offset, inode, rdev), and files
+# are served by slicing the archive at their data offset.
+# Like the kernel unpacking an initramfs, the last entry of a path wins and
+# archives concatenated after a trailer are read as well.
+#
+# Thanks to the last entry winning, a newc archive is patched by appending
+# entries in place of its trailer, followed by a new trailer. write_archive()
+# compacts an archive by writing only the entries in effect.
+#
+# pack() writes a folder as a newc archive. The output only depends on the
+# content of the folder: entries are sorted, inodes are numbered in order
+# and devices are zero. Files of the unpacked image belong to root, so it is
+# also run with sudo by mount.py as:
+#   python3 -m tools.imageManagerUtils.cpio pack <DIR> > <FILE>
+# tree_state() digests the inode, mode, owner, size and times of every entry
+# of a folder. mount.py takes it after unpacking an image, the same with sudo:
+#   python3 -m tools.imageManagerUtils.cpio state <DIR>
+# and skips packing the folder again when the digest has not changed.
+
+# Python buildin modules
+import os
+import sys
+import stat
+import errno
+import hashlib
+import itertools
+import posixpath
+
+# Utils designed for this script
+from . import pathResolver
+
+NEWC_MAGICS = [b'070701', b'070702']
+ODC_MAGIC = b'070707'
+NEWC_HEADER_SIZE = 110
+ODC_HEADER_SIZE = 76
+TRAILER = 'TRAILER!!!'
+# Archives end on a multiple of 512 bytes, same as cpio does
+TRAILER_ALIGNMENT = 512
+# Size of reads from files and of the buffer of the output of pack
+CHUNK_SIZE = 1 << 20
+# Bump this number whenever the format of the index changes
+INDEX_VERSION = 2
+# Fields of an index entry
+MODE, UID, GID, NLINK, MTIME, SIZE, OFFSET, INO, RDEV = range(9)
+
+
+class CpioError(OSError):
+    pass
+
+
+def align4(n):
+    return (n + 3) & ~3
+
+
+def normalize_path(name):
+    """Path relative to the root of the archive, '' being the root itself."""
+    name = posixpath.normpath('/' + name).lstrip('/')
+    return '' if name == '.' else name
+
+
+def parse_header(buf, offset):
+    """Return (name, entry, next offset) of the header at offset."""
+    magic = bytes(buf[offset:offset + 6])
+    if magic in NEWC_MAGICS:
+        header = bytes(buf[offset + 6:offset + NEWC_HEADER_SIZE])
+        if len(header) < NEWC_HEADER_SIZE - 6:
+            raise CpioError('Truncated cpio header at offset {}'.format(offset))
+        fields = [int(header[i:i + 8], 16) for i in range(0, 104, 8)]
+        ino, mode, uid, gid, nlink, mtime, size, dev_major, dev_minor = fields[:9]
+        rdev, namesize = fields[9:11], fields[11]
+        name_start = offset + NEWC_HEADER_SIZE
+        data_start = align4(name_start + namesize)
+        next_offset = align4(data_start + size)
+        ino = (dev_major, dev_minor, ino)
+    elif magic == ODC_MAGIC:
+        header = bytes(buf[offset + 6:offset + ODC_HEADER_SIZE])
+        if len(header) < ODC_HEADER_SIZE - 6:
+            raise CpioError('Truncated cpio header at offset {}'.format(offset))
+        widths = [6, 6, 6, 6, 6, 6, 6, 11, 6, 11]
+        fields, position = [], 0
+        for width in widths:
+            fields.append(int(header[position:position + width], 8))
+            position += width
+        dev, ino, mode, uid, gid, nlink, rdev, mtime, namesize, size = fields
+        rdev = [rdev >> 8, rdev & 0xff]
+        name_start = offset + ODC_HEADER_SIZE
+        data_start = name_start + namesize
+        next_offset = data_start + size
+        ino = (dev, 0, ino)
+    else:
+        raise CpioError('Bad cpio magic number at offset {}'.format(offset))
+    # The name is terminated by NUL, which is counted in namesize
+    name = bytes(buf[name_start:name_start + namesize]).split(b'\0')[0]
+    name = name.decode('utf-8', 'surrogateescape')
+    return name, [mode, uid, gid, nlink, mtime, size, data_start, ino, rdev], next_offset
+
+
+def scan(buf):
+    """Scan all headers of an archive. Return the index of the archive.
+
+    The index is a dict of
+      'entries': path -> entry fields, in the order of the first entry of each path
+      'trailer': offset of the last trailer, where new entries can be appended
+      'end': offset where the archive ends, the size of the image unless it carries
+             other data after the archive, e.g. a compressed initramfs
+      'format': 'newc', 'odc' or 'mixed'
+    """
+    entries = {}
+    formats = set()
+    offset = 0
+    trailer = None
+    while offset < len(buf):
+        magic = bytes(buf[offset:offset + 6])
+        if magic not in NEWC_MAGICS + [ODC_MAGIC]:
+            # Concatenated archives are padded with zeros after the trailer
+            if trailer is not None and len(magic) >= 4 and not any(magic[:4]):
+                offset += 4
+                continue
+            if trailer is not None:
+                break
+        formats.add('odc' if magic == ODC_MAGIC else 'newc')
+        name, entry, next_offset = parse_header(buf, offset)
+        if name == TRAILER:
+            trailer = offset
+        else:
+            # The last entry of a path wins, as when the kernel unpacks an initramfs.
+            # The position of the first one is kept, so that folders come before their content.
+            entries[normalize_path(name)] = entry
+        offset = next_offset
+    if trailer is None:
+        raise CpioError('Missing cpio trailer')
+
+    # Only the last link of a hard linked file carries the data, share it with the others
+    data_of_links = {}
+    for entry in entries.values():
+        if stat.S_ISREG(entry[MODE]) and entry[NLINK] > 1 and entry[SIZE]:
+            data_of_links[entry[INO]] = entry[SIZE], entry[OFFSET]
+    for entry in entries.values():
+        if entry[INO] in data_of_links and stat.S_ISREG(entry[MODE]) and not entry[SIZE]:
+            entry[SIZE], entry[OFFSET] = data_of_links[entry[INO]]
+    # Hard link groups are resolved, keep the inode number only
+    for entry in entries.values():
+        entry[INO] = entry[INO][2]
+    archive_format = formats.pop() if len(formats) == 1 else 'mixed'
+    return {'entries': entries, 'trailer': trailer, 'end': min(offset, len(buf)),
+            'format': archive_format}
+
+
+def newc_header(name, entry):
+    """Return the newc header of entry, followed by its name and the padding."""
+    name = name.encode('utf-8', 'surrogateescape') + b'\0'
+    fields = [entry[INO], entry[MODE], entry[UID], entry[GID], entry[NLINK], entry[MTIME],
+              entry[SIZE], 0, 0, entry[RDEV][0], entry[RDEV][1], len(name), 0]
+    header = NEWC_MAGICS[0] + b''.join(b'%08X' % field for field in fields) + name
+    return header + b'\0' * (align4(len(header)) - len(header))
+
+
+class NewcWriter():
+    """Write newc entries to a file, e.g. a pipe. offset is the position of f in the archive."""
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.offset = offset
+
+    def write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def add(self, path, entry, chunks=()):
+        """Write entry and the chunks of its data. Return the entry pointing to the written data."""
+        entry = list(entry)
+        self.write(newc_header(path or '.', entry))
+        entry[OFFSET] = self.offset
+        for chunk in chunks:
+            self.write(chunk)
+        if self.offset - entry[OFFSET] != entry[SIZE]:
+            raise CpioError('Size of {} changed while writing it'.format(path))
+        self.write(b'\0' * (align4(self.offset) - self.offset))
+        return entry
+
+    def finish(self):
+        """Write the trailer and the padding. Return the offset of the trailer."""
+        trailer = self.offset
+        self.write(newc_header(TRAILER, [0, 0, 0, 1, 0, 0, 0, 0, [0, 0]]))
+        self.write(b'\0' * (-self.offset % TRAILER_ALIGNMENT))
+        return trailer
+
+
+def stat_entry(st, ino):
+    """Return the entry of a file described by st, with its data offset unknown."""
+    mode = st.st_mode
+    size = st.st_size if stat.S_ISREG(mode) or stat.S_ISLNK(mode) else 0
+    rdev = [0, 0]
+    if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        rdev = [os.major(st.st_rdev), os.minor(st.st_rdev)]
+    return [mode, st.st_uid, st.st_gid, st.st_nlink, int(st.st_mtime), size, 0, ino, rdev]
+
+
+def file_chunks(path, st):
+    """Yield the data of the file described by st, i.e. the target of a symbolic link."""
+    if stat.S_ISLNK(st.st_mode):
+        yield os.fsencode(os.readlink(path))
+    elif stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as f:
+            size = st.st_size
+            while size > 0:
+                chunk = f.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    break
+                size -= len(chunk)
+                yield chunk
+
+
+def replace_entry(entries, path, entry):
+    old = entries.get(path)
+    if old and stat.S_ISREG(old[MODE]) and stat.S_ISREG(entry[MODE]) and old[NLINK] > 1:
+        # The kernel rewrites the existing file, which changes all the hard links to it
+        entry[INO], entry[NLINK] = old[INO], old[NLINK]
+        for link, link_entry in entries.items():
+            if is_same_file(link_entry, old):
+                entries[link] = list(entry)
+    entries[path] = entry
+
+
+def is_same_file(a, b):
+    return stat.S_ISREG(a[MODE]) and a[NLINK] > 1 and (a[INO], a[OFFSET]) == (b[INO], b[OFFSET])
+
+
+def append(f, index, records):
+    """Append entries to the newc archive opened in f and update its index.
+
+    records is an iterable of (path, entry, chunks of data). The entries are written in
+    place of the trailer. A new trailer follows them and the file is truncated after it.
+    """
+    f.seek(index['trailer'])
+    writer = NewcWriter(f, index['trailer'])
+    complete = writer.offset
+    try:
+        for path, entry, chunks in records:
+            entry = writer.add(path, entry, chunks)
+            replace_entry(index['entries'], path, entry)
+            complete = writer.offset
+    finally:
+        # Never leave an archive without trailer, drop the entry written partially
+        f.seek(complete)
+        writer.offset = complete
+        index['trailer'] = writer.finish()
+        f.truncate(writer.offset)
+        index['end'] = writer.offset
+
+
+def write_archive(archive, f):
+    """Write the entries in effect of a CpioArchive to f as a newc archive. Return its index."""
+    writer = NewcWriter(f)
+    # Hard links share the inode number and the data, written with the last link only
+    links = {}
+    for path, entry in archive.entries.items():
+        if stat.S_ISREG(entry[MODE]) and entry[NLINK] > 1:
+            links.setdefault((entry[INO], entry[OFFSET]), []).append(path)
+    # Number the inodes again, the archive could join files of different devices
+    inodes = {}
+    entries = {}
+    for path, entry in archive.entries.items():
+        entry = list(entry)
+        group = links.get((entry[INO], entry[OFFSET]), [path])
+        entry[INO] = inodes.setdefault(group[0], len(inodes) + 1)
+        if stat.S_ISREG(entry[MODE]):
+            entry[NLINK] = len(group)
+        if path != group[-1]:
+            entries[path] = writer.add(path, entry[:SIZE] + [0] + entry[OFFSET:])
+            continue
+        data = archive.part.pread(entry[OFFSET], entry[SIZE])
+        entries[path] = writer.add(path, entry, [data])
+        for link in group[:-1]:
+            entries[link][SIZE], entries[link][OFFSET] = entries[path][SIZE], entries[path][OFFSET]
+    trailer = writer.finish()
+    return {'entries': entries, 'trailer': trailer, 'end': writer.offset, 'format': 'newc'}
+
+
+class CpioArchive():
+    def __init__(self, part, index=None):
+        self.part = part
+        self.index = index or scan(part.view)
+        self.entries = self.index['entries']
+        self.children = {'': set()}
+        for path in self.entries:
+            # Archives could omit entries of parent folders, create them implicitly
+            while path:
+                parent, name = posixpath.split(path)
+                self.children.setdefault(parent, set()).add(name)
+                path = parent
+
+    def entry(self, path):
+        if path in self.entries:
+            return self.entries[path]
+        if path in self.children:
+            # Implicit folder
+            return [stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0, 0, 0, [0, 0]]
+        raise FileNotFoundError(errno.ENOENT, 'No such file or directory', path)
+
+    def lookup_child(self, folder, name):
+        path = posixpath.join(folder, name)
+        if path not in self.entries and path not in self.children:
+            return None
+        return path, self.entry(path)[MODE]
+
+    def resolve(self, path, follow_symlinks=True):
+        """Return the normalized path of path after resolving symbolic links in the archive."""
+        return pathResolver.resolve(path, '', self.lookup_child,
+                                    lambda child: self.read_link(self.entry(child)),
+                                    follow_symlinks)
+
+    def read_link(self, entry):
+        data = self.part.pread(entry[OFFSET], entry[SIZE])
+        return bytes(data).decode('utf-8', 'surrogateescape')
+
+    # ================ Interface shared by the readers in fsReader ================
+    def stat(self, path, follow_symlinks=True):
+        entry = self.entry(self.resolve(path, follow_symlinks))
+        return {
+            'mode': entry[MODE],
+            'size': entry[SIZE],
+            'uid': entry[UID],
+            'gid': entry[GID],
+            'mtime': entry[MTIME],
+            'nlink': entry[NLINK],
+            'blocks': -(-entry[SIZE] // 512),
+            'inode': entry[INO],
+        }
+
+    def listdir(self, path):
+        path = self.resolve(path)
+        if not stat.S_ISDIR(self.entry(path)[MODE]):
+            raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+        return list(self.children.get(path, []))
+
+    def readlink(self, path):
+        entry = self.entry(self.resolve(path, follow_symlinks=False))
+        if not stat.S_ISLNK(entry[MODE]):
+            raise OSError(errno.EINVAL, 'Not a symbolic link', path)
+        return self.read_link(entry)
+
+    def iter_chunks(self, path):
+        entry = self.entry(self.resolve(path))
+        if stat.S_ISDIR(entry[MODE]):
+            raise IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+        self.part.readahead(entry[OFFSET], entry[SIZE])
+        yield self.part.pread(entry[OFFSET], entry[SIZE])
+
+    def close(self):
+        self.part.close()
+
+
+def iter_tree(root, path=''):
+    """Yield (path, stat, host path) of the content of root in sorted order, folders first."""
+    entries = sorted(os.scandir(os.path.join(root, path)), key=lambda e: e.name)
+    for e in entries:
+        child = posixpath.join(path, e.name)
+        yield child, e.stat(follow_symlinks=False), e.path
+        if e.is_dir(follow_symlinks=False):
+            yield from iter_tree(root, child)
+
+
+def pack(root, f):
+    """Write the folder root and its content to f as a newc archive."""
+    writer = NewcWriter(f)
+    inodes = {}
+    links = {}
+
+    def add_links(group):
+        for path, entry, host_path, st in group:
+            entry[NLINK] = len(group)
+        # Only the last link carries the data, same as "cpio -H newc"
+        for path, entry, host_path, st in group[:-1]:
+            entry[SIZE] = 0
+            writer.add(path, entry)
+        path, entry, host_path, st = group[-1]
+        writer.add(path, entry, file_chunks(host_path, st))
+
+    tree = itertools.chain([('', os.lstat(root), root)], iter_tree(root))
+    for path, st, host_path in tree:
+        # Number the inodes in order of appearance, hard links share the number of the first one
+        ino = inodes.setdefault((st.st_dev, st.st_ino), len(inodes) + 1)
+        entry = stat_entry(st, ino)
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            group = links.setdefault(ino, [])
+            group.append((path, entry, host_path, st))
+            if len(group) == st.st_nlink:
+                add_links(links.pop(ino))
+            continue
+        writer.add(path, entry, file_chunks(host_path, st))
+    # Files linked from outside of the folder
+    for ino in sorted(links):
+        add_links(links[ino])
+    writer.finish()
+
+
+def tree_state(root):
+    """Return a digest of the metadata of the folder root and its content, not of the data."""
+    digest = hashlib.sha1()
+    tree = itertools.chain([('', os.lstat(root), root)], iter_tree(root))
+    for path, st, host_path in tree:
+        # Writing a file changes its mtime and ctime, replacing it changes its inode
+        digest.update('{}\0{} {} {} {} {} {} {} {} {}\n'.format(
+            path, st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_nlink, st.st_size,
+            st.st_mtime_ns, st.st_ctime_ns, st.st_rdev).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def main(argv):
+    if len(argv) != 2 or argv[0] not in ['pack', 'state']:
+        print('Usage: python3 -m tools.imageManagerUtils.cpio pack <DIR> > <FILE>',
+              file=sys.stderr)
+        print('       python3 -m tools.imageManagerUtils.cpio state <DIR>', file=sys.stderr)
+        exit(1)
+    if argv[0] == 'state':
+        print(tree_state(argv[1]))
+        return
+    with open(sys.stdout.fileno(), 'wb', buffering=CHUNK_SIZE, closefd=False) as out:
+        pack(argv[1], out)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
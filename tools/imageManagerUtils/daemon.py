@@ -0,0 +1,139 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file implements the query daemon and its client.
+# Shell completion issues several queries per TAB, and each of them used to pay
+# the startup of a new Python process. The daemon keeps the image catalog in
+# memory and answers queries over a Unix socket in IMAGE_DIR.
+# The protocol is one JSON object per line in both directions.
+
+# Python buildin modules
+import os
+import sys
+import json
+import signal
+import socket
+import logging as logger
+
+IMAGE_DIR = os.environ.get('IMAGE_DIR')
+SOCKET_PATH = os.path.join(IMAGE_DIR, '.cache', 'imageManager.sock')
+# Seconds to wait for an answer before falling back to run in-process
+CLIENT_TIMEOUT = 5
+# Seconds a connection is kept open without a request
+CONNECTION_TIMEOUT = 60
+
+
+class Connection():
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(CLIENT_TIMEOUT)
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, message):
+        """Send one request. Return None when the daemon does not answer it."""
+        try:
+            self.sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            return json.loads(self.rfile.readline().decode('utf-8'))
+        except (OSError, ValueError) as e:
+            logger.debug('Query daemon does not answer: ' + str(e))
+            return None
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def connect(socket_path=SOCKET_PATH):
+    """Connect to the daemon. Return None when no daemon is serving IMAGE_DIR."""
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        return Connection(socket_path)
+    except OSError as e:
+        logger.debug('Query daemon is not available: ' + str(e))
+        return None
+
+
+def request(message, socket_path=SOCKET_PATH):
+    """Send a request to the daemon. Return None when no daemon answers it."""
+    connection = connect(socket_path)
+    if connection is None:
+        return None
+    with connection:
+        return connection.request(message)
+
+
+def is_serving(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def serve(handler, socket_path=SOCKET_PATH):
+    """Answer requests with handler(message) until SIGINT or SIGTERM."""
+    import socketserver
+    import threading
+    # Each connection has its thread, an idle client must not block the others, but the
+    # requests are answered one at a time, the catalog is not shared between threads
+    handler_lock = threading.Lock()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        timeout = CONNECTION_TIMEOUT
+
+        def handle(self):
+            try:
+                for line in self.rfile:
+                    self.wfile.write(json.dumps(self.answer(line)).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+            except OSError as e:
+                # The client has been idle for too long or is gone
+                logger.debug('Close the connection: ' + str(e))
+
+        def answer(self, line):
+            try:
+                message = json.loads(line.decode('utf-8'))
+                with handler_lock:
+                    return handler(message)
+            except (ValueError, KeyError, TypeError) as e:
+                return {'error': 'Bad request: ' + str(e)}
+            except SystemExit:
+                # The query has logged its error before exit(), it must not stop the daemon
+                return {'error': 'Query failed, see the log of the daemon'}
+            except Exception as e:
+                logger.exception('Query failed')
+                return {'error': 'Query failed: ' + str(e)}
+
+    if is_serving(socket_path):
+        logger.error('Another daemon is serving ' + socket_path)
+        exit(1)
+    # Remove the socket left by a daemon which was killed
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    # Connections left open do not keep the daemon from stopping
+    server.daemon_threads = True
+    # Stop as on SIGINT, SystemExit would be taken for a failing query by the handler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print('Serving queries on ' + socket_path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
@@ -0,0 +1,337 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file is a read-only reader of ext2/3/4 file systems.
+# It lets ls/cat/file/pull look into an image without sudo, a loop mount or
+# ext4fuse. The reader works on a PartitionView (the mapping of the image or
+# of one partition, see partitionView.py) and never copies more than it returns.
+# See https://www.kernel.org/doc/html/latest/filesystems/ext4/ for the layout.
+
+# Python buildin modules
+import stat
+import errno
+import struct
+
+# Utils designed for this script
+from . import pathResolver
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXTENT_MAGIC = 0xF30A
+ROOT_INODE = 2
+
+INCOMPAT_FILETYPE = 0x0002
+INCOMPAT_META_BG = 0x0010
+INCOMPAT_64BIT = 0x0080
+RO_COMPAT_SPARSE_SUPER = 0x0001
+RO_COMPAT_HUGE_FILE = 0x0008
+RO_COMPAT_BIGALLOC = 0x0200
+
+INODE_FLAG_HUGE_FILE = 0x40000
+INODE_FLAG_EXTENTS = 0x80000
+INODE_FLAG_INLINE_DATA = 0x10000000
+# Extents longer than this are uninitialized (preallocated) and read as zeros
+EXTENT_INIT_MAX_LEN = 32768
+# i_block holds 12 direct and 3 indirect block numbers, or inline data
+I_BLOCK_SIZE = 60
+N_DIRECT_BLOCKS = 12
+
+SUPERBLOCK_FORMAT = struct.Struct('<13I3H')
+INODE_FORMAT = struct.Struct('<HHIIIIIHHII4x60s')
+DIRENT_FORMAT = struct.Struct('<IHBB')
+EXTENT_HEADER_FORMAT = struct.Struct('<HHHHI')
+EXTENT_FORMAT = struct.Struct('<IHHI')
+EXTENT_INDEX_FORMAT = struct.Struct('<IIH2x')
+
+
+class ExtError(OSError):
+    pass
+
+
+class Inode():
+    def __init__(self, number, raw, large):
+        (self.mode, uid_lo, size_lo, self.atime, self.ctime, self.mtime, _, gid_lo,
+         self.nlink, blocks_lo, self.flags, self.i_block) = INODE_FORMAT.unpack_from(raw)
+        self.number = number
+        file_acl_lo, size_hi = struct.unpack_from('<II', raw, 0x68)
+        blocks_hi, file_acl_hi, uid_hi, gid_hi = struct.unpack_from('<HHHH', raw, 0x74)
+        self.size = size_lo | size_hi << 32
+        # Block of the extended attributes, 0 when they all fit in the inode
+        self.file_acl = file_acl_lo | file_acl_hi << 32
+        self.uid = uid_lo | uid_hi << 16
+        self.gid = gid_lo | gid_hi << 16
+        self.blocks = blocks_lo | blocks_hi << 32 if large else blocks_lo
+
+    def stat(self, block_size):
+        blocks = self.blocks
+        if self.flags & INODE_FLAG_HUGE_FILE:
+            # Counted in file system blocks instead of 512-byte sectors
+            blocks *= block_size // 512
+        return {
+            'mode': self.mode,
+            'size': self.size,
+            'uid': self.uid,
+            'gid': self.gid,
+            'mtime': self.mtime,
+            'nlink': self.nlink,
+            'blocks': blocks,
+            'inode': self.number,
+        }
+
+
+class ExtFilesystem():
+    def __init__(self, part):
+        self.part = part
+        self.buf = part.view
+        if len(self.buf) < EXT_SUPERBLOCK_OFFSET + 0x200:
+            raise ExtError('Image is too small for an ext file system')
+        sb = SUPERBLOCK_FORMAT.unpack_from(self.buf, EXT_SUPERBLOCK_OFFSET)
+        (self.inodes_count, blocks_count_lo, _, _, _, self.first_data_block, log_block_size,
+         log_cluster_size, self.blocks_per_group, _, self.inodes_per_group, _, _, _, _,
+         magic) = sb
+        if magic != EXT_MAGIC:
+            raise ExtError('Bad magic number of ext superblock')
+        sb_raw = self.part.pread(EXT_SUPERBLOCK_OFFSET, 0x200)
+        rev_level, = struct.unpack_from('<I', sb_raw, 0x4C)
+        self.inode_size = struct.unpack_from('<H', sb_raw, 0x58)[0] if rev_level else 128
+        self.compat, self.incompat, self.ro_compat = struct.unpack_from('<III', sb_raw, 0x5C)
+        desc_size, = struct.unpack_from('<H', sb_raw, 0xFE)
+        self.first_meta_bg, = struct.unpack_from('<I', sb_raw, 0x104)
+        blocks_count_hi, = struct.unpack_from('<I', sb_raw, 0x150)
+
+        self.block_size = 1024 << log_block_size
+        self.cluster_size = self.block_size
+        if self.ro_compat & RO_COMPAT_BIGALLOC:
+            self.cluster_size = 1024 << log_cluster_size
+        self.blocks_count = blocks_count_lo
+        self.desc_size = 32
+        if self.incompat & INCOMPAT_64BIT:
+            self.blocks_count |= blocks_count_hi << 32
+            self.desc_size = max(desc_size, 32)
+        self.groups_count = -(-(self.blocks_count - self.first_data_block) //
+                              self.blocks_per_group)
+        self.large_blocks = bool(self.ro_compat & RO_COMPAT_HUGE_FILE)
+        self.inode_tables = {}
+
+    # ================ Low level layout ================
+    def block(self, number, count=1):
+        return self.part.pread(number * self.block_size, count * self.block_size)
+
+    def group_has_superblock(self, group):
+        if group <= 1 or not self.ro_compat & RO_COMPAT_SPARSE_SUPER:
+            return True
+        for base in [3, 5, 7]:
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def group_desc_location(self, group):
+        descs_per_block = self.block_size // self.desc_size
+        meta_group, index = divmod(group, descs_per_block)
+        if self.incompat & INCOMPAT_META_BG and meta_group >= self.first_meta_bg:
+            # With meta_bg, the descriptors of a meta group live in its first group
+            first_group = meta_group * descs_per_block
+            block = self.first_data_block + first_group * self.blocks_per_group
+            if self.group_has_superblock(first_group):
+                block += 1
+        else:
+            block = self.first_data_block + 1 + meta_group
+        return block * self.block_size + index * self.desc_size
+
+    def inode_table(self, group):
+        if group not in self.inode_tables:
+            offset = self.group_desc_location(group)
+            table_lo, = self.part.unpack('<I', offset + 0x8)
+            table_hi = 0
+            if self.desc_size >= 64:
+                table_hi, = self.part.unpack('<I', offset + 0x28)
+            self.inode_tables[group] = table_lo | table_hi << 32
+        return self.inode_tables[group]
+
+    def inode(self, number):
+        if number < 1 or number > self.inodes_count:
+            raise ExtError('Bad inode number {}'.format(number))
+        group, index = divmod(number - 1, self.inodes_per_group)
+        offset = self.inode_table(group) * self.block_size + index * self.inode_size
+        return Inode(number, self.part.pread(offset, max(self.inode_size, 128)),
+                     self.large_blocks)
+
+    # ================ File data ================
+    def extent_runs(self, node):
+        """Yield (logical block, physical block, length, initialized) of an extent tree."""
+        magic, entries, _, depth, _ = EXTENT_HEADER_FORMAT.unpack_from(node)
+        if magic != EXTENT_MAGIC:
+            raise ExtError('Bad extent header')
+        for i in range(entries):
+            offset = 12 + i * 12
+            if depth == 0:
+                logical, length, start_hi, start_lo = EXTENT_FORMAT.unpack_from(node, offset)
+                initialized = length <= EXTENT_INIT_MAX_LEN
+                if not initialized:
+                    length -= EXTENT_INIT_MAX_LEN
+                yield logical, start_lo | start_hi << 32, length, initialized
+            else:
+                _, leaf_lo, leaf_hi = EXTENT_INDEX_FORMAT.unpack_from(node, offset)
+                yield from self.extent_runs(self.block(leaf_lo | leaf_hi << 32))
+
+    def indirect_runs(self, i_block):
+        """Yield (logical block, physical block, length, True) of an ext2/3 block map."""
+        per_block = self.block_size // 4
+
+        def walk(number, level, logical):
+            if level == 0:
+                yield logical, number, 1, True
+                return
+            entries = struct.unpack('<{}I'.format(per_block), self.block(number))
+            span = per_block**(level - 1)
+            for i, child in enumerate(entries):
+                if child:
+                    yield from walk(child, level - 1, logical + i * span)
+
+        def walk_all():
+            pointers = struct.unpack('<15I', i_block)
+            for i, number in enumerate(pointers[:N_DIRECT_BLOCKS]):
+                if number:
+                    yield i, number, 1, True
+            logical = N_DIRECT_BLOCKS
+            for level, number in enumerate(pointers[N_DIRECT_BLOCKS:], 1):
+                if number:
+                    yield from walk(number, level, logical)
+                logical += per_block**level
+
+        # Merge contiguous blocks into runs, which are read as one chunk
+        run = None
+        for logical, physical, _, _ in walk_all():
+            if run and logical == run[0] + run[2] and physical == run[1] + run[2]:
+                run[2] += 1
+                continue
+            if run:
+                yield tuple(run)
+            run = [logical, physical, 1, True]
+        if run:
+            yield tuple(run)
+
+    def iter_inode_chunks(self, inode):
+        """Yield the content of an inode as memoryview chunks, holes as zero bytes."""
+        if inode.flags & INODE_FLAG_INLINE_DATA:
+            if inode.size > I_BLOCK_SIZE:
+                raise ExtError('Inline data stored in extended attributes is not supported')
+            yield memoryview(inode.i_block[:inode.size])
+            return
+        if inode.flags & INODE_FLAG_EXTENTS:
+            runs = self.extent_runs(memoryview(inode.i_block))
+        else:
+            runs = self.indirect_runs(inode.i_block)
+        position = 0
+        # Both block maps and extent trees are walked in logical order
+        for logical, physical, length, initialized in runs:
+            start = logical * self.block_size
+            if start >= inode.size:
+                break
+            if start > position:
+                yield from zero_chunks(start - position)
+            length = min(length * self.block_size, inode.size - start)
+            if initialized:
+                first = physical * self.block_size
+                # Let the kernel read the whole run while the first pages are written out
+                self.part.readahead(first, length)
+                yield self.part.pread(first, length)
+            else:
+                yield from zero_chunks(length)
+            position = start + length
+        if position < inode.size:
+            yield from zero_chunks(inode.size - position)
+
+    def read_inode(self, inode):
+        return b''.join(self.iter_inode_chunks(inode))
+
+    # ================ Directories and paths ================
+    def dir_entries(self, inode):
+        """Yield (name, inode number, file type) of a directory, including "." and "..".
+
+        Hashed (htree) directories keep their index in entries with inode 0, so a linear
+        scan over all blocks sees every name.
+        """
+        data = self.read_inode(inode)
+        if inode.flags & INODE_FLAG_INLINE_DATA:
+            # Inline directories start with the inode number of the parent
+            parent, = struct.unpack_from('<I', data)
+            yield '.', inode.number, stat.S_IFDIR
+            yield '..', parent, stat.S_IFDIR
+            data = data[4:]
+        offset = 0
+        while offset + DIRENT_FORMAT.size <= len(data):
+            number, rec_len, name_len, file_type = DIRENT_FORMAT.unpack_from(data, offset)
+            if rec_len < DIRENT_FORMAT.size:
+                break
+            if not self.incompat & INCOMPAT_FILETYPE:
+                name_len |= file_type << 8
+            if number:
+                start = offset + DIRENT_FORMAT.size
+                name = bytes(data[start:start + name_len]).decode('utf-8', 'surrogateescape')
+                yield name, number, file_type
+            offset += rec_len
+
+    def lookup_child(self, inode, name):
+        for entry_name, number, _ in self.dir_entries(inode):
+            if entry_name == name:
+                child = self.inode(number)
+                return child, child.mode
+        return None
+
+    def lookup_inode(self, path, follow_symlinks=True):
+        """Return the inode of path. Symbolic links are resolved inside the image."""
+        return pathResolver.resolve(path, self.inode(ROOT_INODE), self.lookup_child,
+                                    self.read_link, follow_symlinks)
+
+    def is_fast_symlink(self, inode):
+        # Same test as ext4_inode_is_fast_symlink() of the kernel: no block is allocated but
+        # the one of the extended attributes, the size alone is not enough
+        if inode.flags & INODE_FLAG_INLINE_DATA:
+            return False
+        ea_blocks = self.cluster_size // 512 if inode.file_acl else 0
+        return inode.blocks - ea_blocks == 0
+
+    def read_link(self, inode):
+        if self.is_fast_symlink(inode):
+            # Fast symbolic links keep the target in i_block
+            target = inode.i_block[:inode.size]
+        else:
+            target = self.read_inode(inode)
+        return bytes(target).decode('utf-8', 'surrogateescape')
+
+    # ================ Interface shared by the readers in fsReader ================
+    def stat(self, path, follow_symlinks=True):
+        return self.lookup_inode(path, follow_symlinks).stat(self.block_size)
+
+    def listdir(self, path):
+        inode = self.lookup_inode(path)
+        if not stat.S_ISDIR(inode.mode):
+            raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+        return [name for name, _, _ in self.dir_entries(inode) if name not in ['.', '..']]
+
+    def readlink(self, path):
+        inode = self.lookup_inode(path, follow_symlinks=False)
+        if not stat.S_ISLNK(inode.mode):
+            raise OSError(errno.EINVAL, 'Not a symbolic link', path)
+        return self.read_link(inode)
+
+    def iter_chunks(self, path):
+        inode = self.lookup_inode(path)
+        if stat.S_ISDIR(inode.mode):
+            raise IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+        return self.iter_inode_chunks(inode)
+
+    def close(self):
+        self.part.close()
+
+
+ZERO_CHUNK = memoryview(bytes(1 << 20))
+
+
+def zero_chunks(length):
+    while length > 0:
+        yield ZERO_CHUNK[:min(length, len(ZERO_CHUNK))]
+        length -= len(ZERO_CHUNK)
@@ -0,0 +1,268 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file is a read-only reader of FAT12/16/32 file systems, e.g. the boot
+# partition holding BOOT.bin, the devicetree and uEnv.txt.
+# Like extfs, it works on a PartitionView (the mapping of one partition of an
+# image) and lets ls/cat/file/pull look into it without sudo or a loop
+# mount. Long file names (VFAT) are supported, names are case insensitive.
+# See "Microsoft FAT Specification" (fatgen103) for the layout.
+
+# Python buildin modules
+import stat
+import time
+import errno
+import struct
+
+BOOT_SECTOR_FORMAT = struct.Struct('<3x8sHBHBHHBHHHII')
+FAT32_FORMAT = struct.Struct('<I4xI')
+DIRENT_FORMAT = struct.Struct('<11sBBBHHHHHHHI')
+DIRENT_SIZE = 32
+BOOT_SIGNATURE = b'\x55\xaa'
+
+ATTR_READ_ONLY = 0x01
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_LONG_NAME = 0x0F
+LAST_LONG_ENTRY = 0x40
+# Flags of the reserved byte, set by Windows NT for short names in lower case
+NT_LOWER_BASE = 0x08
+NT_LOWER_EXT = 0x10
+# First byte of the name of free entries
+FREE_ENTRY = 0xE5
+END_OF_ENTRIES = 0x00
+# Short names use the OEM code page, 437 is the default of Linux (vfat) and DOS
+SHORT_NAME_ENCODING = 'cp437'
+
+
+class FatError(OSError):
+    pass
+
+
+def is_fat(boot_sector):
+    """Check the boot sector of a partition for a sane FAT BIOS parameter block."""
+    if len(boot_sector) < 512 or boot_sector[510:512] != BOOT_SIGNATURE:
+        return False
+    (_, bytes_per_sector, sectors_per_cluster, reserved, fats, _, total16, _, fat_size16,
+     _, _, _, total32) = BOOT_SECTOR_FORMAT.unpack_from(boot_sector)
+    fat_size = fat_size16 or FAT32_FORMAT.unpack_from(boot_sector, 36)[0]
+    return (bytes_per_sector in [512, 1024, 2048, 4096] and
+            sectors_per_cluster in [1, 2, 4, 8, 16, 32, 64, 128] and
+            reserved >= 1 and fats >= 1 and fat_size > 0 and (total16 or total32) > 0)
+
+
+def decode_time(date, time_of_day):
+    # FAT keeps the local time with a two-second resolution
+    try:
+        return int(time.mktime(((date >> 9) + 1980, (date >> 5) & 0x0F, date & 0x1F,
+                                time_of_day >> 11, (time_of_day >> 5) & 0x3F,
+                                (time_of_day & 0x1F) * 2, 0, 0, -1)))
+    except (OverflowError, ValueError):
+        return 0
+
+
+def short_name_checksum(raw_name):
+    checksum = 0
+    for c in raw_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    return checksum
+
+
+def decode_short_name(raw_name, flags):
+    raw_name = bytes(raw_name)
+    if raw_name[0] == 0x05:
+        # 0xE5 is a valid first character, stored as 0x05 since 0xE5 marks free entries
+        raw_name = b'\xe5' + raw_name[1:]
+    base = raw_name[:8].decode(SHORT_NAME_ENCODING).rstrip(' ')
+    ext = raw_name[8:].decode(SHORT_NAME_ENCODING).rstrip(' ')
+    if flags & NT_LOWER_BASE:
+        base = base.lower()
+    if flags & NT_LOWER_EXT:
+        ext = ext.lower()
+    return base + '.' + ext if ext else base
+
+
+def decode_long_name(parts):
+    # The name is padded with a NUL and then 0xFFFF
+    name = b''.join(parts).decode('utf-16-le', 'surrogatepass')
+    return name.split('\0')[0]
+
+
+class Entry():
+    def __init__(self, name, attr, cluster, size, mtime):
+        self.name = name
+        self.attr = attr
+        self.cluster = cluster
+        self.size = size
+        self.mtime = mtime
+
+    def is_dir(self):
+        return bool(self.attr & ATTR_DIRECTORY)
+
+    def stat(self, cluster_size):
+        if self.is_dir():
+            mode, nlink, size = stat.S_IFDIR | 0o755, 2, cluster_size
+        else:
+            mode, nlink, size = stat.S_IFREG | 0o644, 1, self.size
+        if self.attr & ATTR_READ_ONLY:
+            mode &= ~0o222
+        return {
+            'mode': mode,
+            'size': size,
+            'uid': 0,
+            'gid': 0,
+            'mtime': self.mtime,
+            'nlink': nlink,
+            # Allocated in whole clusters, counted in 512-byte sectors
+            'blocks': -(-size // cluster_size) * cluster_size // 512,
+            'inode': self.cluster,
+        }
+
+
+class FatFilesystem():
+    def __init__(self, part):
+        self.part = part
+        self.buf = part.view
+        if not is_fat(self.buf[:512]):
+            raise FatError('Bad FAT boot sector')
+        (_, self.bytes_per_sector, sectors_per_cluster, reserved, fats, root_entries, total16, _,
+         fat_size16, _, _, _, total32) = BOOT_SECTOR_FORMAT.unpack_from(self.buf)
+        fat_size32, root_cluster = FAT32_FORMAT.unpack_from(self.buf, 36)
+        fat_size = fat_size16 or fat_size32
+        total_sectors = total16 or total32
+        root_dir_sectors = -(-root_entries * DIRENT_SIZE // self.bytes_per_sector)
+        first_data_sector = reserved + fats * fat_size + root_dir_sectors
+
+        self.cluster_size = sectors_per_cluster * self.bytes_per_sector
+        self.cluster_count = (total_sectors - first_data_sector) // sectors_per_cluster
+        self.fat_offset = reserved * self.bytes_per_sector
+        self.root_offset = (reserved + fats * fat_size) * self.bytes_per_sector
+        self.root_size = root_entries * DIRENT_SIZE
+        self.data_offset = first_data_sector * self.bytes_per_sector
+        # The type only depends on the number of clusters
+        if self.cluster_count < 4085:
+            self.fat_type = 12
+        elif self.cluster_count < 65525:
+            self.fat_type = 16
+        else:
+            self.fat_type = 32
+        # FAT12 and FAT16 have a fixed root folder, FAT32 keeps it in a cluster chain
+        root_cluster = root_cluster if self.fat_type == 32 else 0
+        self.root = Entry('', ATTR_DIRECTORY, root_cluster, 0, 0)
+
+    # ================ Low level layout ================
+    def next_cluster(self, cluster):
+        if self.fat_type == 12:
+            value, = struct.unpack_from('<H', self.buf, self.fat_offset + cluster + cluster // 2)
+            return value >> 4 if cluster & 1 else value & 0x0FFF
+        elif self.fat_type == 16:
+            return struct.unpack_from('<H', self.buf, self.fat_offset + cluster * 2)[0]
+        return struct.unpack_from('<I', self.buf, self.fat_offset + cluster * 4)[0] & 0x0FFFFFFF
+
+    def cluster_runs(self, cluster):
+        """Yield (first cluster, number of clusters) of the contiguous runs of a chain."""
+        start, count = cluster, 0
+        # Never follow more links than clusters, in case the chain is cyclic
+        for _ in range(self.cluster_count):
+            # Values out of the data clusters end the chain (end of chain, bad or free clusters)
+            if not 2 <= cluster < self.cluster_count + 2:
+                break
+            if cluster != start + count:
+                yield start, count
+                start, count = cluster, 0
+            count += 1
+            cluster = self.next_cluster(cluster)
+        if count:
+            yield start, count
+
+    def iter_cluster_chunks(self, cluster, size=None):
+        for start, count in self.cluster_runs(cluster):
+            offset = self.data_offset + (start - 2) * self.cluster_size
+            length = count * self.cluster_size
+            if size is not None:
+                length = min(length, size)
+                size -= length
+            self.part.readahead(offset, length)
+            yield self.part.pread(offset, length)
+            if size == 0:
+                break
+
+    def dir_entries(self, directory):
+        """Yield the entries of a folder, with their long names when present."""
+        if directory.cluster == 0:
+            chunks = [self.part.pread(self.root_offset, self.root_size)]
+        else:
+            chunks = self.iter_cluster_chunks(directory.cluster)
+        long_parts = {}
+        checksum = None
+        for chunk in chunks:
+            for offset in range(0, len(chunk) - DIRENT_SIZE + 1, DIRENT_SIZE):
+                raw = chunk[offset:offset + DIRENT_SIZE]
+                if raw[0] == END_OF_ENTRIES:
+                    return
+                if raw[0] == FREE_ENTRY:
+                    long_parts = {}
+                    continue
+                (raw_name, attr, flags, _, _, _, _, cluster_hi, write_time, write_date,
+                 cluster_lo, size) = DIRENT_FORMAT.unpack_from(raw)
+                if attr & 0x3F == ATTR_LONG_NAME:
+                    # Parts of a long name come in reverse order before the short entry
+                    if raw[0] & LAST_LONG_ENTRY:
+                        long_parts = {}
+                        checksum = raw[13]
+                    characters = [raw[1:11], raw[14:26], raw[28:32]]
+                    long_parts[raw[0] & 0x1F] = b''.join(bytes(c) for c in characters)
+                    continue
+                if attr & ATTR_VOLUME_ID:
+                    long_parts = {}
+                    continue
+                name = decode_short_name(raw_name, flags)
+                if (long_parts and checksum == short_name_checksum(raw_name) and
+                        sorted(long_parts) == list(range(1, len(long_parts) + 1))):
+                    name = decode_long_name([long_parts[i] for i in sorted(long_parts)])
+                long_parts = {}
+                cluster = cluster_lo | (cluster_hi << 16 if self.fat_type == 32 else 0)
+                yield Entry(name, attr, cluster, size, decode_time(write_date, write_time))
+
+    def lookup(self, path):
+        entry = self.root
+        for name in [p for p in path.split('/') if p]:
+            if not entry.is_dir():
+                raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+            if name == '.' or (name == '..' and entry is self.root):
+                # The root folder has no entries of its own, its parent is itself
+                continue
+            # Names are case insensitive
+            matches = [e for e in self.dir_entries(entry) if e.name.lower() == name.lower()]
+            if not matches:
+                raise FileNotFoundError(errno.ENOENT, 'No such file or directory', path)
+            entry = matches[0]
+            if entry.name == '..':
+                # ".." of a child of the root points to cluster 0, i.e. the root
+                entry = self.root if entry.cluster == 0 else entry
+        return entry
+
+    # ================ Interface shared by the readers in fsReader ================
+    def stat(self, path, follow_symlinks=True):
+        # There are no symbolic links in FAT
+        return self.lookup(path).stat(self.cluster_size)
+
+    def listdir(self, path):
+        entry = self.lookup(path)
+        if not entry.is_dir():
+            raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+        return [e.name for e in self.dir_entries(entry) if e.name not in ['.', '..']]
+
+    def readlink(self, path):
+        self.lookup(path)
+        raise OSError(errno.EINVAL, 'Not a symbolic link', path)
+
+    def iter_chunks(self, path):
+        entry = self.lookup(path)
+        if entry.is_dir():
+            raise IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+        if entry.size == 0:
+            return iter([])
+        return self.iter_cluster_chunks(entry.cluster, entry.size)
+
+    def close(self):
+        self.part.close()
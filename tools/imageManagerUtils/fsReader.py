@@ -0,0 +1,458 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file runs the read-only commands (ls, cat, file and pull) inside the
+# Python process with the file system readers, e.g. extfs, fat and cpio.
+# No sudo, mount or unmount is involved. Commands or images which are not
+# supported here fall back to the mount based implementation in imageManager.
+#
+# Every reader provides the same interface:
+#   stat(path, follow_symlinks=True) -> dict of mode, size, uid, gid, mtime, nlink, blocks
+#   listdir(path) -> list of names
+#   readlink(path) -> target of a symbolic link
+#   iter_chunks(path) -> iterator of bytes-like chunks of a file
+# Paths are relative to the root of the file system. Errors are raised as OSError.
+#
+# CPIO images are also patched here: push appends entries to the archive
+# (see cpio.py) and compact rewrites it with the entries in effect only.
+# Compressed images are decompressed to a temporary file first and are
+# compressed again with the same options when they are patched.
+
+# Python buildin modules
+import os
+import sys
+import stat
+import errno
+import time
+import struct
+import posixpath
+import functools
+import itertools
+import logging as logger
+
+# Utils designed for this script
+from . import fat
+from . import cpio
+from . import extfs
+from . import catalog
+from . import compression
+from . import partitionView
+
+# Commands which can be served by the readers
+COMMANDS = ['ls', 'cat', 'file', 'pull']
+# Flags of ls understood by list_directory
+LS_FLAGS = 'aAlh1'
+# Raised by the readers on what they cannot read, the mounted image is used instead
+READER_ERRORS = (extfs.ExtError, fat.FatError, cpio.CpioError)
+
+
+class ImageFilesystem():
+    """Map (a partition of) an open image file and open a reader on it."""
+    def __init__(self, f, offset, size, reader_class=None):
+        self.file = f
+        try:
+            self.partition = partitionView.PartitionView.map_file(self.file, offset, size)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        try:
+            # The file system is detected on the same mapping as it is read from
+            reader_class = reader_class or detect_reader(self.partition)
+            if reader_class is None:
+                raise OSError(errno.ENODEV, 'Unknown file system')
+            self.fs = reader_class(self.partition)
+        except BaseException:
+            self.partition.close()
+            self.file.close()
+            raise
+
+    def detach_file(self):
+        """Keep the image file open after closing, the caller takes it over."""
+        f, self.file = self.file, None
+        return f
+
+    def close(self):
+        # Readers close the view they are given, which unmaps the image
+        self.fs.close()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self.fs
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def detect_reader(partition):
+    header = partition.view[:extfs.EXT_SUPERBLOCK_OFFSET + 0x3A]
+    magic = header[extfs.EXT_SUPERBLOCK_OFFSET + 0x38:]
+    if len(magic) == 2 and struct.unpack('<H', magic)[0] == extfs.EXT_MAGIC:
+        return extfs.ExtFilesystem
+    if fat.is_fat(header[:512]):
+        return fat.FatFilesystem
+    return None
+
+
+def open_image_data(image):
+    """Return the image file, or a temporary file holding the data of a compressed image."""
+    options = image.get('compression')
+    if options is None:
+        return open(image['path'], 'rb')
+    import tempfile
+    f = tempfile.TemporaryFile(prefix='imageManager-')
+    try:
+        compression.decompress(image['path'], options, f)
+        f.flush()
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def open_cpio(image):
+    path = image['path']
+    # Scanning the headers of a big archive is the expensive part, cache the index
+    try:
+        st = os.stat(path)
+        index = catalog.load_image_cache('cpio', path, st, cpio.INDEX_VERSION)
+        image_fs = ImageFilesystem(open_image_data(image), 0, None,
+                                   functools.partial(cpio.CpioArchive, index=index))
+    except (OSError, ValueError) as e:
+        logger.debug('Cannot open the cpio archive {}: {}'.format(path, e))
+        return None
+    if index is None:
+        catalog.save_image_cache('cpio', path, st, image_fs.fs.index, cpio.INDEX_VERSION)
+    if image_fs.fs.index['end'] != len(image_fs.partition):
+        # Data follows the archive, e.g. a compressed initramfs appended to it
+        image_fs.close()
+        return None
+    return image_fs
+
+
+def open_filesystem(image):
+    """Return an ImageFilesystem of the target of image, or None when it is not supported."""
+    offset, size = 0, None
+    if image['type'] == 'CPIO':
+        return open_cpio(image)
+    elif image['type'] == 'MBR':
+        part = partitionView.find_partition(image['partitionTable'],
+                                            image.get('targetPartition'))
+        if part is None:
+            return None
+        offset, size = part['offset'], part['sizelimit']
+    elif image['type'] != 'E2FS':
+        return None
+    try:
+        return ImageFilesystem(open(image['path'], 'rb'), offset, size)
+    except OSError as e:
+        logger.debug('Cannot open the file system of {}: {}'.format(image['path'], e))
+        return None
+
+
+def run_command(fs, command, path, argv):
+    """Run command on fs. Return False when the options or the image are not supported here."""
+    if command in ['cat', 'file'] and argv:
+        # Options of cat and file, e.g. "cat -n", are left to the commands on the mounted image
+        return False
+    try:
+        if command == 'ls':
+            return list_directory(fs, path, argv)
+        elif command == 'cat':
+            cat_file(fs, path)
+        elif command == 'file':
+            describe_file(fs, path)
+        elif command == 'pull':
+            pull(fs, path, argv[0])
+    except READER_ERRORS as e:
+        # A feature the readers do not implement, e.g. ext4 inline data in extended attributes
+        logger.debug('Cannot {} {} without mounting: {}'.format(command, path, e))
+        return False
+    return True
+
+
+# ================ ls ================
+def parse_ls_flags(argv):
+    flags = set()
+    for arg in argv:
+        if arg.startswith('--') or not all(c in LS_FLAGS for c in arg[1:]):
+            return None
+        flags.update(arg[1:])
+    return flags
+
+
+def format_mtime(mtime):
+    # Same as ls, show the year instead of the time for files older than six months
+    if abs(time.time() - mtime) > 60 * 60 * 24 * 182:
+        return time.strftime('%b %e  %Y', time.localtime(mtime))
+    return time.strftime('%b %e %H:%M', time.localtime(mtime))
+
+
+def print_long_format(fs, dir_path, names, flags, show_total):
+    rows = []
+    total = 0
+    for name in names:
+        path = posixpath.join(dir_path, name)
+        st = fs.stat(path, follow_symlinks=False)
+        total += st['blocks']
+        size = catalog.human_readable_size(st['size']) if 'h' in flags else str(st['size'])
+        if stat.S_ISLNK(st['mode']):
+            name = '{} -> {}'.format(name, fs.readlink(path))
+        rows.append([stat.filemode(st['mode']), str(st['nlink']), str(st['uid']), str(st['gid']),
+                     size, format_mtime(st['mtime']), name])
+    if show_total:
+        # Counted in 1K blocks, as ls does
+        total = -(-total // 2)
+        size = catalog.human_readable_size(total * 1024) if 'h' in flags else str(total)
+        print('total ' + size)
+    widths = [max([len(row[i]) for row in rows] + [0]) for i in range(5)]
+    for row in rows:
+        print('{} {} {} {} {} {} {}'.format(row[0], row[1].rjust(widths[1]),
+                                            row[2].ljust(widths[2]), row[3].ljust(widths[3]),
+                                            row[4].rjust(widths[4]), row[5], row[6]))
+
+
+def print_columns(names):
+    import shutil
+    # Fill columns top-down, as "ls -C" does on a terminal
+    width = shutil.get_terminal_size().columns
+    for cols in range(len(names), 0, -1):
+        rows = -(-len(names) // cols)
+        columns = [names[i:i + rows] for i in range(0, len(names), rows)]
+        widths = [max(len(name) for name in column) + 2 for column in columns]
+        if sum(widths) - 2 <= width or cols == 1:
+            break
+    for r in range(rows):
+        line = ''.join(column[r].ljust(w) for column, w in zip(columns, widths) if r < len(column))
+        print(line.rstrip())
+
+
+def list_directory(fs, path, argv):
+    flags = parse_ls_flags(argv)
+    if flags is None:
+        return False
+    # As ls, -l shows a symlink itself, otherwise a symlink to a folder lists the folder
+    try:
+        st = fs.stat(path, follow_symlinks=('l' not in flags))
+    except FileNotFoundError:
+        # A dangling symlink is still printed
+        st = fs.stat(path, follow_symlinks=False)
+    if stat.S_ISDIR(st['mode']):
+        names = fs.listdir(path)
+        if 'a' in flags:
+            names += ['.', '..']
+        elif 'A' not in flags:
+            names = [name for name in names if not name.startswith('.')]
+        dir_path, names = path, sorted(names)
+    else:
+        # Print files with their path, as ls does with its arguments
+        dir_path, names = '', ['/' + path]
+    if 'l' in flags:
+        print_long_format(fs, dir_path, names, flags, stat.S_ISDIR(st['mode']))
+    elif sys.stdout.isatty() and '1' not in flags and names:
+        print_columns(names)
+    else:
+        for name in names:
+            print(name)
+    return True
+
+
+# ================ cat and file ================
+def cat_file(fs, path):
+    out = sys.stdout.buffer
+    for chunk in fs.iter_chunks(path):
+        out.write(chunk)
+    out.flush()
+
+
+def describe_file(fs, path):
+    st = fs.stat(path, follow_symlinks=False)
+    mode = st['mode']
+    if stat.S_ISLNK(mode):
+        description = 'symbolic link to ' + fs.readlink(path)
+    elif stat.S_ISDIR(mode):
+        description = 'directory'
+    elif stat.S_ISREG(mode):
+        # Let "file" look at the content, it only needs a readable copy of the file
+        import tempfile
+        import subprocess
+        with tempfile.NamedTemporaryFile(prefix='imageManager-') as f:
+            for chunk in fs.iter_chunks(path):
+                f.write(chunk)
+            f.flush()
+            description = subprocess.check_output(['file', '-b', f.name]).decode('utf-8')
+        description = description.strip()
+    else:
+        description = {
+            stat.S_IFCHR: 'character special',
+            stat.S_IFBLK: 'block special',
+            stat.S_IFIFO: 'fifo (named pipe)',
+            stat.S_IFSOCK: 'socket',
+        }.get(stat.S_IFMT(mode), 'unknown')
+    print('/{}: {}'.format(path, description))
+
+
+# ================ pull ================
+def extract(fs, path, host_path):
+    st = fs.stat(path, follow_symlinks=False)
+    mode = st['mode']
+    if stat.S_ISDIR(mode):
+        os.makedirs(host_path, exist_ok=True)
+        for name in fs.listdir(path):
+            extract(fs, posixpath.join(path, name), os.path.join(host_path, name))
+    elif stat.S_ISLNK(mode):
+        if os.path.lexists(host_path):
+            os.unlink(host_path)
+        os.symlink(fs.readlink(path), host_path)
+        return
+    elif stat.S_ISREG(mode):
+        with open(host_path, 'wb') as f:
+            for chunk in fs.iter_chunks(path):
+                f.write(chunk)
+    else:
+        # Device nodes, fifos and sockets need root to be created
+        logger.warning('Skip special file /' + path)
+        return
+    os.chmod(host_path, stat.S_IMODE(mode))
+    os.utime(host_path, (st['mtime'], st['mtime']))
+
+
+def pull(fs, path, host_file):
+    # Follow the rules of "rsync -a SRC DEST"
+    st = fs.stat(path, follow_symlinks=False)
+    name = posixpath.basename(path.rstrip('/'))
+    if stat.S_ISDIR(st['mode']) and (path.endswith('/') or not name):
+        # A trailing slash copies the content of the folder
+        extract(fs, path, host_file)
+    elif os.path.isdir(host_file) or host_file.endswith('/'):
+        extract(fs, path.rstrip('/'), os.path.join(host_file, name))
+    else:
+        extract(fs, path.rstrip('/'), host_file)
+
+
+# ================ push and compact of cpio archives ================
+def iter_host_records(host_path, path, uid, gid, inodes, follow_symlinks=False):
+    """Yield (path, entry, chunks) of host_path and its content, with the ownership uid:gid."""
+    st = os.stat(host_path) if follow_symlinks else os.lstat(host_path)
+    entry = cpio.stat_entry(st, next(inodes))
+    # Hard links of the host are pushed as separate files
+    entry[cpio.UID], entry[cpio.GID] = uid, gid
+    entry[cpio.NLINK] = 2 if stat.S_ISDIR(st.st_mode) else 1
+    yield path, entry, cpio.file_chunks(host_path, st)
+    if stat.S_ISDIR(st.st_mode):
+        for name in sorted(os.listdir(host_path)):
+            yield from iter_host_records(os.path.join(host_path, name), posixpath.join(path, name),
+                                         uid, gid, inodes)
+
+
+def resolve_existing(archive, path):
+    """Return the resolved longest existing prefix of path and the missing components."""
+    parts = [p for p in path.split('/') if p]
+    for i in range(len(parts), -1, -1):
+        try:
+            return archive.resolve('/'.join(parts[:i])), parts[i:]
+        except FileNotFoundError:
+            continue
+
+
+def push_records(archive, host_file, target):
+    """Return the records to append for pushing host_file to target, as "rsync -a" does."""
+    base, missing = resolve_existing(archive, target)
+    # A trailing slash copies the content of the folder
+    content_only = os.path.isdir(host_file) and host_file.endswith('/')
+    if missing:
+        into_dir = target.endswith('/') or (os.path.isdir(host_file) and not content_only)
+        owner = base
+    else:
+        into_dir = stat.S_ISDIR(archive.stat(base)['mode'])
+        if not into_dir:
+            # As rsync, a symlink to a file is replaced, not the file it points to
+            parent, name = posixpath.split(target.rstrip('/'))
+            base = posixpath.join(archive.resolve(parent), name)
+        owner = base if into_dir else posixpath.dirname(base)
+    # Same as "--chown", the new files belong to the owner of the folder receiving them
+    owner_st = archive.stat(owner)
+    uid, gid = owner_st['uid'], owner_st['gid']
+    inodes = iter(range(max([e[cpio.INO] for e in archive.entries.values()] + [0]) + 1, 1 << 32))
+
+    root = posixpath.join(base, *missing)
+    folders = missing if into_dir and not content_only else missing[:-1]
+    if into_dir and not content_only:
+        root = posixpath.join(root, os.path.basename(host_file.rstrip('/')))
+    records = []
+    mtime = int(time.time())
+    for i in range(len(folders)):
+        # Create the missing parents, the kernel does not create them when unpacking
+        path = posixpath.join(base, *folders[:i + 1])
+        entry = [stat.S_IFDIR | 0o755, uid, gid, 2, mtime, 0, 0, next(inodes), [0, 0]]
+        records.append((path, entry, ()))
+    return itertools.chain(records, iter_host_records(host_file, root, uid, gid, inodes,
+                                                      follow_symlinks=content_only))
+
+
+def rewrite_image(path, write):
+    """Replace the image at path with the content written by write(f)."""
+    import tempfile
+    # Replace the file a symlink points to, not the symlink itself
+    path = os.path.realpath(path)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    # Write next to the image and replace it at once, the image is never left half written
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.rewrite-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            result = write(f)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return result
+
+
+def push_cpio(image, host_file):
+    """Push host_file into a newc image by appending entries. Return False when not supported."""
+    options = image.get('compression')
+    image_fs = open_cpio(image)
+    if image_fs is None:
+        return False
+    with image_fs as archive:
+        if archive.index['format'] != 'newc':
+            return False
+        if not os.path.lexists(host_file):
+            raise FileNotFoundError(errno.ENOENT, 'No such file or directory', host_file)
+        records = push_records(archive, host_file, image['targetPath'])
+        index = archive.index
+        # The decompressed archive is patched, then compressed again
+        data_file = image_fs.detach_file() if options else None
+    # The archive must be unmapped before it is resized
+    if data_file is None:
+        with open(image['path'], 'r+b') as f:
+            cpio.append(f, index, records)
+    else:
+        with data_file:
+            cpio.append(data_file, index, records)
+            data_file.seek(0)
+            rewrite_image(image['path'], lambda f: compression.compress(options, data_file, f))
+    catalog.save_image_cache('cpio', image['path'], os.stat(image['path']), index,
+                             cpio.INDEX_VERSION)
+    return True
+
+
+def compact_cpio(image):
+    """Rewrite a cpio image with the entries in effect only. Return the sizes before and after."""
+    path, options = image['path'], image.get('compression')
+    image_fs = open_cpio(image)
+    if image_fs is None:
+        raise cpio.CpioError('Cannot read the cpio archive ' + path)
+    size = os.stat(path).st_size
+
+    def write(f):
+        if options is None:
+            return cpio.write_archive(archive, f)
+        with compression.open_compressor(options, f) as writer:
+            return cpio.write_archive(archive, writer)
+
+    with image_fs as archive:
+        index = rewrite_image(path, write)
+    st = os.stat(path)
+    catalog.save_image_cache('cpio', path, st, index, cpio.INDEX_VERSION)
+    return size, st.st_size
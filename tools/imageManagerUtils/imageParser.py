@@ -3,12 +3,9 @@
 # Python buildin modules
 import os
 import sys
-import re
+import struct
 import logging as logger
 
-# Utils designed for this script
-from . import sh
-
 IMAGE_DIR = os.environ.get('IMAGE_DIR')
 
 
@@ -24,58 +21,295 @@ def locate_image_path(image):
     return tmp
 
 
-def get_type(text):
-    if 'ASCII cpio archive' in text:
-        return 'CPIO'
-    elif 'MBR boot sector' in text:
-        return 'MBR'
-    elif re.match(r'.*Linux .* ext[0-9] filesystem.*', text):
-        return 'E2FS'
-    return ''
+# Magic numbers of the image formats, see "man 5 cpio", "man 5 ext4" and the UEFI spec
+CPIO_MAGICS = [b'070701', b'070702', b'070707']
+# Magic numbers of compression.MAGICS, compressed cpio archives are looked into
+COMPRESSION_MAGICS = (b'\x1f\x8b', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd', b'\x02\x21\x4c\x18')
+MBR_SIGNATURE_OFFSET = 510
+MBR_SIGNATURE = b'\x55\xaa'
+GPT_HEADER_OFFSET = 512
+GPT_SIGNATURE = b'EFI PART'
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+# The header must cover the fields read from the ext superblock
+HEADER_SIZE = 2048
 
+SECTOR_SIZE = 512
+# MBR, GPT header and the 128 GPT entries of a standard table fit in the first 34 sectors
+PARTITION_HEADER_SECTORS = 34
+MAX_LOGICAL_PARTITIONS = 128
+GPT_ENTRY_MIN_SIZE = 128
+# Entries are 128 bytes in practice, larger ones are taken for a broken header
+GPT_ENTRY_MAX_SIZE = 4096
+# Entries of a standard GPT, larger tables are rejected
+GPT_MAX_ENTRIES = 128
+MBR_EXTENDED_TYPES = [0x05, 0x0F, 0x85]
+# Linux, W95 FAT32 and W95 FAT32 (LBA)
+MBR_MOUNTABLE_TYPES = [0x83, 0x0B, 0x0C]
+GPT_MOUNTABLE_TYPES = [
+    '0FC63DAF-8483-4772-8E79-3D69D8477DE4',    # Linux filesystem
+    'C12A7328-F81F-11D2-BA4B-00A0C93EC93B',    # EFI System
+]
 
-def parse_image_type(image):
-    # Trace symbolic link with -L
-    image_format = sh.file('-L', image, _ok_code=range(255))
-    if 'ASCII cpio archive' in image_format:
-        return 'CPIO'
-    elif 'MBR boot sector' in image_format:
-        return 'MBR'
-    elif re.match(r'.*Linux .* ext[0-9] filesystem.*', str(image_format)):
-        return 'E2FS'
-    return ''
-
-
-def parse_partition_table(file_path):
-    # This is the magic function which makes thing so easy
-    def numbers_in_text(text, indexes):
-        numbers = [int(s) for s in text.split() if s.isdigit()]
-        if isinstance(indexes, int):
-            return numbers[indexes]
+EXT_COMPAT_FEATURES = {
+    0x0001: 'dir_prealloc',
+    0x0002: 'imagic_inodes',
+    0x0004: 'has_journal',
+    0x0008: 'ext_attr',
+    0x0010: 'resize_inode',
+    0x0020: 'dir_index',
+    0x0200: 'sparse_super2',
+}
+EXT_INCOMPAT_FEATURES = {
+    0x0001: 'compression',
+    0x0002: 'filetype',
+    0x0004: 'needs_recovery',
+    0x0008: 'journal_dev',
+    0x0010: 'meta_bg',
+    0x0040: 'extent',
+    0x0080: '64bit',
+    0x0100: 'mmp',
+    0x0200: 'flex_bg',
+    0x0400: 'ea_inode',
+    0x1000: 'dirdata',
+    0x2000: 'metadata_csum_seed',
+    0x4000: 'large_dir',
+    0x8000: 'inline_data',
+    0x10000: 'encrypt',
+}
+EXT_RO_COMPAT_FEATURES = {
+    0x0001: 'sparse_super',
+    0x0002: 'large_file',
+    0x0004: 'btree_dir',
+    0x0008: 'huge_file',
+    0x0010: 'uninit_bg',
+    0x0020: 'dir_nlink',
+    0x0040: 'extra_isize',
+    0x0100: 'quota',
+    0x0200: 'bigalloc',
+    0x0400: 'metadata_csum',
+    0x1000: 'readonly',
+    0x2000: 'project',
+}
+# Features understood by ext2/ext3 drivers. Anything else makes it an ext4 file system.
+EXT2_INCOMPAT = 0x0002 | 0x0004 | 0x0008 | 0x0010
+EXT2_RO_COMPAT = 0x0001 | 0x0002 | 0x0004
+
+
+def read_image_header(image, size=HEADER_SIZE):
+    try:
+        with open(image, 'rb') as f:
+            return f.read(size)
+    except OSError:
+        return b''
+
+
+def has_mbr_partition_table(header):
+    if header[MBR_SIGNATURE_OFFSET:MBR_SIGNATURE_OFFSET + 2] != MBR_SIGNATURE:
+        return False
+    if header[GPT_HEADER_OFFSET:GPT_HEADER_OFFSET + 8] == GPT_SIGNATURE:
+        return True
+    # A FAT boot sector also ends with 0x55AA, but its boot code does not leave valid
+    # boot indicators (0x00 or 0x80) in the four partition entries.
+    entries = [header[446 + i * 16:446 + (i + 1) * 16] for i in range(4)]
+    if any(e[0] not in (0x00, 0x80) for e in entries):
+        return False
+    return any(e[4] != 0 for e in entries)
+
+
+def parse_ext_features(header):
+    sb = header[EXT_SUPERBLOCK_OFFSET:]
+    compat, incompat, ro_compat = struct.unpack_from('<III', sb, 0x5C)
+
+    def flag_names(flags, names):
+        return [name for bit, name in sorted(names.items()) if flags & bit]
+
+    if incompat & ~EXT2_INCOMPAT or ro_compat & ~EXT2_RO_COMPAT:
+        variant = 'ext4'
+    elif compat & 0x0004:
+        variant = 'ext3'
+    else:
+        variant = 'ext2'
+    features = (flag_names(compat, EXT_COMPAT_FEATURES) +
+                flag_names(incompat, EXT_INCOMPAT_FEATURES) +
+                flag_names(ro_compat, EXT_RO_COMPAT_FEATURES))
+    return variant, features
+
+
+def sniff_header(header):
+    """Classify an image from its first HEADER_SIZE bytes without calling "file"."""
+    info = {'type': '', 'variant': '', 'features': [], 'compression': None}
+    if header[:6] in CPIO_MAGICS:
+        info['type'] = 'CPIO'
+        info['variant'] = 'odc' if header[:6] == b'070707' else 'newc'
+    elif has_mbr_partition_table(header):
+        info['type'] = 'MBR'
+        if header[GPT_HEADER_OFFSET:GPT_HEADER_OFFSET + 8] == GPT_SIGNATURE:
+            info['variant'] = 'gpt'
         else:
-            return [numbers[i] for i in indexes]
+            info['variant'] = 'dos'
+    elif len(header) >= EXT_SUPERBLOCK_OFFSET + 0x68 and struct.unpack_from(
+            '<H', header, EXT_SUPERBLOCK_OFFSET + 0x38)[0] == EXT_MAGIC:
+        info['type'] = 'E2FS'
+        info['variant'], info['features'] = parse_ext_features(header)
+    return info
+
+
+def sniff_image(image):
+    # open() follows symbolic links, as "file -L" did
+    header = read_image_header(image)
+    info = sniff_header(header)
+    options = None
+    if not info['type'] and header.startswith(COMPRESSION_MAGICS):
+        # Imported for compressed images only, it is not needed to classify the others
+        from . import compression
+        options = compression.parse_options(header)
+    if options:
+        # Look into compressed images, only compressed cpio archives (initramfs) are supported
+        try:
+            inner = sniff_header(compression.read_head(image, options, HEADER_SIZE))
+        except OSError:
+            return info
+        if inner['type'] == 'CPIO':
+            inner['compression'] = options
+            return inner
+    return info
+
+
+def parse_image_type(image):
+    return sniff_image(image)['type']
+
+
+def read_mbr_entries(sector):
+    entries = []
+    for i in range(4):
+        status, part_type, start, size = struct.unpack_from('<B3xB3xII', sector, 446 + i * 16)
+        entries.append({
+            'bootable': status == 0x80,
+            'type': part_type,
+            'start': start,
+            'size': size,
+        })
+    return entries
+
+
+def read_mbr_partitions(f, header, sector_size):
+    partitions = []
+    for number, entry in enumerate(read_mbr_entries(header), 1):
+        if entry['type'] == 0 or entry['size'] == 0:
+            continue
+        entry['number'] = number
+        partitions.append(entry)
+
+    # Logical partitions are chained by extended boot records (EBR) inside the extended one.
+    extended = [p for p in partitions if p['type'] in MBR_EXTENDED_TYPES]
+    if not extended:
+        return partitions
+    ext_start = extended[0]['start']
+    ebr_start = ext_start
+    number = 5
+    # Limit the number of EBRs to stop on broken (cyclic) chains
+    for _ in range(MAX_LOGICAL_PARTITIONS):
+        f.seek(ebr_start * sector_size)
+        ebr = f.read(sector_size)
+        if len(ebr) < sector_size or ebr[MBR_SIGNATURE_OFFSET:] != MBR_SIGNATURE:
+            break
+        logical, next_ebr = read_mbr_entries(ebr)[:2]
+        if logical['type'] != 0 and logical['size'] != 0:
+            # The start of a logical partition is relative to its EBR
+            logical['start'] += ebr_start
+            logical['number'] = number
+            partitions.append(logical)
+            number += 1
+        if next_ebr['type'] not in MBR_EXTENDED_TYPES or next_ebr['start'] == 0:
+            break
+        # The start of the next EBR is relative to the extended partition
+        ebr_start = ext_start + next_ebr['start']
+    return partitions
+
+
+def read_gpt_partitions(f, header, sector_size):
+    """Return the partitions of the GPT, raise ValueError when the table is broken."""
+    gpt = header[sector_size:sector_size * 2]
+    entries_lba, num_entries, entry_size, entries_crc = struct.unpack_from('<QIII', gpt, 72)
+    if not GPT_ENTRY_MIN_SIZE <= entry_size <= GPT_ENTRY_MAX_SIZE or entry_size % 8 != 0:
+        raise ValueError('Bad size of GPT entries {}'.format(entry_size))
+    if num_entries > GPT_MAX_ENTRIES:
+        raise ValueError('Too many GPT entries {}'.format(num_entries))
+    entries_offset = entries_lba * sector_size
+    entries_end = entries_offset + num_entries * entry_size
+    if entries_end > os.fstat(f.fileno()).st_size:
+        raise ValueError('GPT entries are beyond the end of the image')
+    if entries_end > len(header):
+        f.seek(entries_offset)
+        table = f.read(num_entries * entry_size)
+    else:
+        table = header[entries_offset:entries_end]
+
+    # Only GPT images need them, importing them costs more than the rest of a query
+    import uuid
+    import zlib
+    if len(table) != num_entries * entry_size or zlib.crc32(table) != entries_crc:
+        raise ValueError('Bad CRC of GPT entries')
+    partitions = []
+    for number in range(1, num_entries + 1):
+        entry = table[(number - 1) * entry_size:number * entry_size]
+        type_guid = uuid.UUID(bytes_le=entry[0:16])
+        if type_guid.int == 0:
+            continue
+        first_lba, last_lba, attributes = struct.unpack_from('<QQQ', entry, 32)
+        partitions.append({
+            'number': number,
+            'bootable': bool(attributes & 0x4),
+            'type': str(type_guid).upper(),
+            'start': first_lba,
+            'size': last_lba - first_lba + 1,
+        })
+    return partitions
+
+
+def parse_partition_table(file_path, sector_size=SECTOR_SIZE):
+    """Read the MBR (and GPT if present) of an image directly from its first sectors."""
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(PARTITION_HEADER_SECTORS * sector_size)
+            is_gpt = header[sector_size:sector_size + 8] == GPT_SIGNATURE
+            if header[MBR_SIGNATURE_OFFSET:sector_size] != MBR_SIGNATURE:
+                partitions = []
+            elif is_gpt:
+                try:
+                    partitions = read_gpt_partitions(f, header, sector_size)
+                except ValueError as e:
+                    # Listed without partitions, as an image with a broken MBR
+                    logger.warning('Ignore the GPT of {}: {}'.format(file_path, e))
+                    partitions = []
+            else:
+                partitions = read_mbr_partitions(f, header, sector_size)
+    except OSError as e:
+        logger.error('Cannot read partition table of {}: {}'.format(file_path, e))
+        exit(1)
 
-    info = sh.fdisk('-l', file_path, _tty_out=False).split('\n')
-    img = {'sectorSize': numbers_in_text(info[1], 2), 'partitions': []}
-    # Starting from the 3rd line, find the lines with file_path text in it.
-    partition_infos = [v for v in info[3:] if file_path in v]
-    sizelimit = 0
+    img = {'sectorSize': sector_size, 'scheme': 'gpt' if is_gpt else 'dos', 'partitions': []}
     logger.debug('Partitions of image ' + file_path)
-    for p in partition_infos:
+    for p in partitions:
         logger.debug(p)
-        n = numbers_in_text(p, [0, 1, 2])
-        if '83 Linux' in p or 'FAT32' in p or 'Linux filesystem' in p or 'EFI System' in p:
-            mountable = True
+        if is_gpt:
+            mountable = p['type'] in GPT_MOUNTABLE_TYPES
+            type_id = p['type']
         else:
-            mountable = False
-        sizelimit += n[2]
+            mountable = p['type'] in MBR_MOUNTABLE_TYPES
+            type_id = '0x{:02x}'.format(p['type'])
         img['partitions'].append({
-            'name': p.split()[0],
-            'start': n[0],
-            'end': n[1],
-            'size': n[2],
-            'offset': n[0] * img['sectorSize'],
-            'sizelimit': sizelimit * img['sectorSize'],
+            'name': file_path + str(p['number']),
+            'number': p['number'],
+            'type': type_id,
+            'bootable': p['bootable'],
+            'start': p['start'],
+            'end': p['start'] + p['size'] - 1,
+            'size': p['size'],
+            'offset': p['start'] * sector_size,
+            # Size limit of the loop device, relative to its offset
+            'sizelimit': p['size'] * sector_size,
             'mountable': mountable,
         })
     return img
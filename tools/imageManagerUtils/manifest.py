@@ -0,0 +1,176 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file keeps a manifest of the file tree of each image: every path with
+# its mode, size, owner, mtime and the target of symbolic links. It is built
+# once with the readers of fsReader and cached under .cache/manifest/, tagged
+# with the fingerprint of the image, so it is only built again after the image
+# changes. Shell completion and ls are served from it without reading, let
+# alone mounting, the image.
+#
+# A manifest maps each folder to its entries:
+#   {'root': entry, 'dirs': {folder path: {name: entry}}}
+# where paths are relative to the root of the file system ('' is the root).
+# The manifests of the partitions of an MBR image are kept in the same cache
+# file, under 'p<N>', the one of other images under ''.
+
+# Python buildin modules
+import os
+import stat
+import errno
+import posixpath
+import logging as logger
+
+# Utils designed for this script
+from . import catalog
+from . import fsReader
+from . import pathResolver
+
+# Bump this number whenever the format of the manifest changes
+MANIFEST_VERSION = 1
+# Fields of an entry
+MODE, SIZE, UID, GID, MTIME, NLINK, BLOCKS, TARGET = range(8)
+
+
+def make_entry(fs, path):
+    st = fs.stat(path, follow_symlinks=False)
+    target = fs.readlink(path) if stat.S_ISLNK(st['mode']) else None
+    return [st['mode'], st['size'], st['uid'], st['gid'], st['mtime'], st['nlink'], st['blocks'],
+            target]
+
+
+def build(fs):
+    """Walk a reader of fsReader and return the manifest of its file tree."""
+    dirs = {}
+    pending = ['']
+    while pending:
+        path = pending.pop()
+        entries = dirs[path] = {}
+        try:
+            names = fs.listdir(path)
+        except OSError as e:
+            logger.debug('Cannot list /{}: {}'.format(path, e))
+            continue
+        for name in names:
+            child = posixpath.join(path, name)
+            try:
+                entries[name] = make_entry(fs, child)
+            except OSError as e:
+                logger.debug('Cannot stat /{}: {}'.format(child, e))
+                continue
+            if stat.S_ISDIR(entries[name][MODE]):
+                pending.append(child)
+    return {'root': make_entry(fs, ''), 'dirs': dirs}
+
+
+def manifest_key(image):
+    return 'p{}'.format(image.get('targetPartition')) if image['type'] == 'MBR' else ''
+
+
+def load(image, build_missing=True):
+    """Return a ManifestTree of the target of image, or None when it cannot be read.
+
+    The cached manifest is used when it matches the image. Otherwise it is built now, or None is
+    returned when build_missing is False.
+    """
+    path, key = image['path'], manifest_key(image)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    manifests = catalog.load_image_cache('manifest', path, st, MANIFEST_VERSION) or {}
+    if key not in manifests:
+        if not build_missing:
+            return None
+        image_fs = fsReader.open_filesystem(image)
+        if image_fs is None:
+            return None
+        try:
+            with image_fs as fs:
+                manifests[key] = build(fs)
+        except OSError as e:
+            logger.debug('Cannot build the manifest of {}: {}'.format(path, e))
+            return None
+        # Tagged with the stat taken before reading, an image changed meanwhile is read again
+        catalog.save_image_cache('manifest', path, st, manifests, MANIFEST_VERSION)
+    return ManifestTree(manifests[key])
+
+
+class ManifestTree():
+    """Serve the reader interface of fsReader from a manifest, without the content of files."""
+    def __init__(self, manifest):
+        self.root = manifest['root']
+        self.dirs = manifest['dirs']
+
+    def entry(self, path):
+        if not path:
+            return self.root
+        parent, name = posixpath.split(path)
+        return self.dirs[parent][name]
+
+    def lookup_child(self, folder, name):
+        entry = self.dirs.get(folder, {}).get(name)
+        if entry is None:
+            return None
+        return posixpath.join(folder, name), entry[MODE]
+
+    def resolve(self, path, follow_symlinks=True):
+        """Return the path of path in the manifest after resolving symbolic links."""
+        return pathResolver.resolve(path, '', self.lookup_child,
+                                    lambda child: self.entry(child)[TARGET], follow_symlinks)
+
+    # ================ Interface shared by the readers in fsReader ================
+    def stat(self, path, follow_symlinks=True):
+        entry = self.entry(self.resolve(path, follow_symlinks))
+        return {
+            'mode': entry[MODE],
+            'size': entry[SIZE],
+            'uid': entry[UID],
+            'gid': entry[GID],
+            'mtime': entry[MTIME],
+            'nlink': entry[NLINK],
+            'blocks': entry[BLOCKS],
+        }
+
+    def listdir(self, path):
+        path = self.resolve(path)
+        if not stat.S_ISDIR(self.entry(path)[MODE]):
+            raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+        return list(self.dirs.get(path, {}))
+
+    def readlink(self, path):
+        entry = self.entry(self.resolve(path, follow_symlinks=False))
+        if not stat.S_ISLNK(entry[MODE]):
+            raise OSError(errno.EINVAL, 'Not a symbolic link', path)
+        return entry[TARGET]
+
+    def iter_chunks(self, path):
+        raise OSError(errno.EOPNOTSUPP, 'The manifest has no content of files', path)
+
+    def complete(self, dir_path, partial):
+        """Return the names in dir_path starting with partial, folders with a trailing slash."""
+        try:
+            names = self.listdir(dir_path)
+        except OSError:
+            return []
+        result = []
+        for name in sorted(names):
+            # Hidden files are only completed when asked for, same as ls without -a
+            if not name.startswith(partial) or (name.startswith('.') and
+                                                not partial.startswith('.')):
+                continue
+            try:
+                is_dir = stat.S_ISDIR(self.stat(posixpath.join(dir_path, name))['mode'])
+            except OSError:
+                # Broken symbolic links
+                is_dir = False
+            result.append(name + '/' if is_dir else name)
+        return result
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -2,34 +2,69 @@
 
 # Python buildin modules
 import os
+import re
 import sys
+import stat
+import time
+import ctypes
+import signal
+import filecmp
+import tempfile
 import subprocess
 import logging as logger
 
 # Utils designed for this script
 from . import sh
+from . import catalog
+from . import session
+from . import compression
+from . import partitionView
 
 IMAGE_DIR = os.environ.get('IMAGE_DIR')
-# The name of ROOTFS_DIR must be .rootfs for safety.
+# The name of ROOTFS_DIR must be .rootfs for safety. Each image is mounted onto a folder in it.
 ROOTFS_DIR = os.path.join(IMAGE_DIR, '.rootfs')
 LOOP_DIR = os.path.join(IMAGE_DIR, '.loops')
+# syncfs(2) flushes one file system, sync(1) flushes all of them on the host
+LIBC = ctypes.CDLL(None, use_errno=True)
+# Longest time the process closing idle sessions sleeps
+REAPER_INTERVAL = 5
+# The folder holding "tools", for running "python3 -m tools.imageManagerUtils.cpio" with sudo
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def release_sessions_or_exit(image):
+    """Close the sessions of image before mounting it elsewhere, exit while a command uses one."""
+    # Mounting the image twice could corrupt it, unpacking a CPIO image would miss the changes
+    flush_sessions(image['path'])
+    if session.find(image['path']) is not None:
+        logger.error('{} is used by another command, try again later'.format(image['path']))
+        exit(1)
 
 
 def automount(image, mount_point, user=False, withFork=False):
     path_exist_or_exit(mount_point)
+    release_sessions_or_exit(image)
+    # A command forked earlier could still be mounting onto the same folder
+    session.wait_jobs(mount_point=os.path.realpath(mount_point))
     try_unmount(mount_point, user)
     if withFork:
-        pid = os.fork()
-        # parent process, return and keep running
-        if pid > 0: return
+        # The child is tracked as a job, "wait" returns once it is mounted
+        start_job('mount', mount_point, image['path'],
+                  lambda: mount_all(image, mount_point, user))
+        return
+    mount_all(image, mount_point, user)
+
+
+def mount_all(image, mount_point, user=False):
+    """Mount image, each partition of an MBR image onto p<N>, or unpack it onto mount_point."""
     if image['type'] == 'MBR':
         sh.mkdir('-p', LOOP_DIR)
         if user:
             try_unmount(LOOP_DIR, user)
             sh.mbrfs(image['path'], LOOP_DIR)
-        for idx, part in enumerate(image['partitionTable']):
-            source_file = os.path.join(LOOP_DIR, str(idx + 1))
-            target_folder = os.path.join(mount_point, 'p' + str(idx + 1))
+        for part in image['partitionTable']['partitions']:
+            source_file = os.path.join(LOOP_DIR, str(part['number']))
+            target_folder = os.path.join(mount_point, 'p' + str(part['number']))
             try_unmount(target_folder, user)
             if user:
                 sh.mkdir('-p', target_folder)
@@ -37,15 +72,16 @@ def automount(image, mount_point, user=False, withFork=False):
                 sh.ext4fuse(source_file, target_folder, _ok_code=range(255))
             else:
                 sh.sudo.mkdir('-p', target_folder, _fg=True)
-                options = get_mount_options(image, idx + 1, noerror=True)
+                options = get_mount_options(image, part['number'], noerror=True)
                 if options:
                     sh.sudo.mount(image['path'], target_folder, options=options, _fg=True)
     elif image['type'] == 'CPIO':
         safely_clean_dir(mount_point, user)
-        if user:
-            os.system('cd {} && cpio -idu --quiet < "{}"'.format(mount_point, image['path']))
-        else:
-            os.system('cd {} && sudo cpio -idu --quiet < "{}"'.format(mount_point, image['path']))
+        unpack_cpio(image['path'], mount_point, user)
+        if not user:
+            state = tree_state(mount_point)
+            with session.SessionTable() as table:
+                table.trees[os.path.realpath(mount_point)] = state
     else:
         try_unmount(mount_point, user)
         if user:
@@ -56,11 +92,13 @@ def automount(image, mount_point, user=False, withFork=False):
 
 def autounmount(image, mount_point, user=False):
     path_exist_or_exit(mount_point)
+    release_sessions_or_exit(image)
+    session.wait_jobs(mount_point=os.path.realpath(mount_point))
     if image['type'] == 'MBR':
         try_unmount(mount_point, user)
         try_unmount(LOOP_DIR, user=True)
-        for idx, part in enumerate(image['partitionTable']):
-            target_folder = os.path.join(mount_point, 'p' + str(idx + 1))
+        for part in image['partitionTable']['partitions']:
+            target_folder = os.path.join(mount_point, 'p' + str(part['number']))
             try_unmount(target_folder, user)
             if user and os.path.exists(target_folder):
                 sh.rmdir(target_folder, _fg=True, _ok_code=range(255))
@@ -68,8 +106,9 @@ def autounmount(image, mount_point, user=False):
                 sh.sudo.rmdir(target_folder, _fg=True, _ok_code=range(255))
     elif image['type'] == 'CPIO':
         if not user:
-            os.system('cd {} && sudo find . | sudo cpio -H newc --quiet -o > "{}"'.format(
-                mount_point, image['path']))
+            with session.SessionTable() as table:
+                state = table.trees.pop(os.path.realpath(mount_point), None)
+            repack_changed_cpio(mount_point, image['path'], state)
         safely_clean_dir(mount_point, user)
     else:
         try_unmount(mount_point, user)
@@ -87,10 +126,41 @@ def path_exist_or_exit(path):
         exit(1)
 
 
-def try_unmount(mount_point, user=False):
+def is_mounted(path):
+    """Return True when a file system is mounted onto path, without running mountpoint."""
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/self/mounts', 'r') as f:
+            # Spaces and the like are escaped as octal numbers, e.g. "\040"
+            return any(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                              line.split()[1]) == path for line in f)
+    except OSError:
+        return os.path.ismount(path)
+
+
+def sync_mount(mount_point):
+    """Flush the file system mounted onto mount_point, nothing when it is not mounted."""
+    if not is_mounted(mount_point):
+        return
+    try:
+        fd = os.open(mount_point, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        fd = None
+    if fd is not None:
+        try:
+            if hasattr(LIBC, 'syncfs') and LIBC.syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    logger.debug('Cannot syncfs {}, sync all file systems'.format(mount_point))
     sh.sync()
+
+
+def try_unmount(mount_point, user=False):
+    if not is_mounted(mount_point):
+        return
+    sync_mount(mount_point)
     try:
-        sh.mountpoint(mount_point, '-q')
         if user:
             sh.fusermount('-quz', mount_point, _fg=True)
         else:
@@ -103,26 +173,103 @@ def safely_clean_dir(mount_point, user=False):
     if not os.path.exists(mount_point):
         sh.mkdir('-p', mount_point)
         return 0
-    try:
-        sh.mountpoint(mount_point, '-q')
+    if is_mounted(mount_point):
         logger.error('Error: Mount point is sill occupied by others: ' + mount_point)
         exit(1)
-    except sh.ErrorReturnCode:
-        pass
+    # Never cross into the images still mounted below, e.g. in ROOTFS_DIR
     if user:
-        sh.rm('-rf', mount_point, _fg=True)
+        sh.rm('-rf', '--one-file-system', mount_point, _fg=True)
     else:
-        sh.sudo.rm('-rf', mount_point, _fg=True)
+        sh.sudo.rm('-rf', '--one-file-system', mount_point, _fg=True)
     sh.mkdir('-p', mount_point)
     return 0
 
 
+def unpack_cpio(image_file, mount_point, user=False):
+    # -m keeps the mtimes, so that packing an unchanged tree gives the same archive
+    command = 'cpio -idum --quiet' if user else 'sudo cpio -idum --quiet'
+    options = compression.detect_file(image_file)
+    if options is None:
+        command = '{} < "{}"'.format(command, image_file)
+    else:
+        command = '{} < "{}" | {}'.format(compression.decompress_command(options), image_file,
+                                          command)
+    os.system('cd {} && {}'.format(mount_point, command))
+
+
+def repack_cpio(mount_point, image_file, user=False):
+    """Pack mount_point into image_file. The image is only replaced when its content changes."""
+    # Replace the file a symlink points to, not the symlink itself
+    image_file = os.path.realpath(image_file)
+    image_dir = os.path.dirname(image_file)
+    # Write a new file next to the image, the image is never truncated or left half written
+    fd, tmp_path = tempfile.mkstemp(dir=image_dir, prefix='.repack-')
+    command = [sys.executable, '-m', 'tools.imageManagerUtils.cpio', 'pack',
+               os.path.abspath(mount_point)]
+    if not user:
+        command = ['sudo'] + command
+    # Compress with the options of the image, e.g. the level
+    options = compression.detect_file(image_file)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if options is None:
+                # The packer writes to the file directly, its output is not copied by this process
+                ret = subprocess.call(command, stdout=f, cwd=PACKAGE_ROOT)
+            else:
+                packer = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=PACKAGE_ROOT)
+                failed = False
+                try:
+                    compression.compress(options, packer.stdout, f)
+                except OSError as e:
+                    logger.error(str(e))
+                    packer.kill()
+                    failed = True
+                finally:
+                    packer.stdout.close()
+                ret = packer.wait() or failed
+        if ret:
+            logger.error('Fail to pack {} into {}'.format(mount_point, image_file))
+            exit(1)
+        if filecmp.cmp(tmp_path, image_file, shallow=False):
+            # Keep the image untouched, so are its mtime and the caches keyed on it
+            logger.debug('Content of {} is not changed'.format(image_file))
+            return
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(image_file).st_mode))
+        os.replace(tmp_path, image_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def tree_state(mount_point, user=False):
+    """Return the digest of the CPIO tree unpacked in mount_point, None when it cannot be read."""
+    command = [sys.executable, '-m', 'tools.imageManagerUtils.cpio', 'state',
+               os.path.abspath(mount_point)]
+    if not user:
+        command = ['sudo'] + command
+    try:
+        return subprocess.check_output(command, cwd=PACKAGE_ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def repack_changed_cpio(mount_point, image_file, state):
+    """Pack mount_point into image_file unless the tree still has the digest state."""
+    if state is not None and tree_state(mount_point) == state:
+        logger.debug('{} is not changed, skip packing it'.format(mount_point))
+        return
+    repack_cpio(mount_point, image_file)
+
+
 def get_mount_options(image, partition=1, noerror=False):
     img = image.get('partitionTable')
     if img is None: return None
     logger.debug(img)
 
-    part = img['partitions'][partition - 1]
+    part = partitionView.find_partition(img, partition)
+    if part is None:
+        logger.error('Target partition not found: p' + str(partition))
+        exit(1)
     if part['mountable'] == False:
         if noerror:
             return None
@@ -147,16 +294,13 @@ class Cpio():
         logger.debug('Unfold {} onto {}'.format(self.image_file, self.mount_point))
         try_unmount(self.mount_point)
         safely_clean_dir(self.mount_point)
-        os.system('cd {} && sudo cpio -idu --quiet < "{}"'.format(self.mount_point,
-                                                                  self.image_file))
+        unpack_cpio(self.image_file, self.mount_point)
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        sh.sync()
-        os.system('cd {} && sudo find . | sudo cpio -H newc --quiet -o > "{}"'.format(
-            self.mount_point, self.image_file))
+        repack_cpio(self.mount_point, self.image_file)
         safely_clean_dir(self.mount_point)
         logger.debug('Clean {}'.format(self.mount_point))
 
@@ -180,46 +324,264 @@ class Mount():
         return self
 
     def __exit__(self, type, value, traceback):
-        sh.sync()
+        sync_mount(self.mount_point)
         # Try to umount and ignore any errors
         sh.sudo.umount(self.mount_point, '-R', '-l', _ok_code=range(255), _fg=True)
         logger.debug('Unmount {}'.format(self.mount_point))
 
 
 class AutoMount():
-    def __init__(self, *args, **kwargs):
+    """Mount (or unpack) an image onto its folder in ROOTFS_DIR for a command.
+
+    The image is left mounted as a session when the command ends, the following commands on the
+    same image reuse it. See session.py.
+    With read_only, the image is mounted read-only, or the CPIO image is never packed again.
+    """
+    def __init__(self, *args, read_only=False, **kwargs):
         self.image = args[0]
-        self.mount_point = ROOTFS_DIR
+        self.read_only = read_only
+        self.mount_point = image_mount_point(self.image)
         self.image_file = self.image['path']
         self.image_type = self.image['type']
 
         file_exist_or_exit(self.image_file)
-        path_exist_or_exit(self.mount_point)
-        logger.debug('Unfold/Mount {} onto {}'.format(self.image_file, self.mount_point))
-
+        path_exist_or_exit(ROOTFS_DIR)
+        with image_lock(self.mount_point):
+            with session.SessionTable() as table:
+                record = table.sessions.get(self.mount_point)
+                if record is not None and self.is_reusable(record):
+                    logger.debug('Reuse {} on {}'.format(self.image_file, self.mount_point))
+                    if not self.read_only:
+                        # The unpacked tree is packed when the session closes from now on
+                        record['readOnly'] = False
+                    record['holders'].append(os.getpid())
+                    return
+                if record is not None and record['holders']:
+                    logger.error('{} is used by PID {} on {}'.format(
+                        self.mount_point, ' '.join(map(str, record['holders'])), record['image']))
+                    exit(1)
+            if record is not None:
+                close_session(self.mount_point, record)
+            logger.debug('Unfold/Mount {} onto {}'.format(self.image_file, self.mount_point))
+            os.makedirs(self.mount_point, exist_ok=True)
+            fingerprint, state = self.open()
+            record = session.make_record(self.image, fingerprint, self.read_only, state)
+            record['holders'].append(os.getpid())
+            with session.SessionTable() as table:
+                table.sessions[self.mount_point] = record
+
+    def is_reusable(self, record):
+        key = [self.image_type, self.image.get('targetPartition')]
+        if [record['type'], record['partition']] != key:
+            return False
+        if not session.same_image(self.image_file, record['image']):
+            return False
+        if self.image_type == 'CPIO':
+            # The image must not have been written since it was unpacked
+            return (os.path.isdir(self.mount_point) and
+                    record['fingerprint'] == image_fingerprint(self.image_file))
+        if record.get('readOnly') and not self.read_only:
+            # Loop devices set up read-only cannot be remounted read-write, mount it again
+            return False
+        return is_mounted(self.mount_point)
+
+    def open(self):
         try_unmount(self.mount_point)
         if self.image_type == 'CPIO':
             safely_clean_dir(self.mount_point)
-            os.system('cd {} && sudo cpio -idu --quiet < "{}"'.format(self.mount_point,
-                                                                      self.image_file))
-        elif self.image_type == 'MBR':
+            fingerprint = image_fingerprint(self.image_file)
+            unpack_cpio(self.image_file, self.mount_point)
+            return fingerprint, tree_state(self.mount_point)
+        # Mounting read-write writes to the image, e.g. the mount time in the superblock
+        mode = ['ro'] if self.read_only else []
+        if self.image_type == 'MBR':
             # Try to get options, return None if it does not require any options
             options = get_mount_options(self.image, self.image.get('targetPartition'))
-            # Try to umount and ignore any errors
+            options = ','.join(([options] if options else []) + mode) or None
+            logger.debug('Mount with options: {}'.format(options))
             sh.sudo.mount(self.image_file, self.mount_point, options=options, _fg=True)
+        elif mode:
+            sh.sudo.mount(self.image_file, self.mount_point, options=','.join(mode), _fg=True)
         else:
             sh.sudo.mount(self.image_file, self.mount_point, _fg=True)
+        return None, None
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        sh.sync()
-        if self.image_type == 'CPIO':
-            os.system('cd {} && sudo find . | sudo cpio -H newc --quiet -o > "{}"'.format(
-                self.mount_point, self.image_file))
-            safely_clean_dir(self.mount_point)
+        # The session stays mounted, flush what the command wrote to the image anyway
+        sync_mount(self.mount_point)
+        with session.SessionTable() as table:
+            record = table.sessions.get(self.mount_point)
+            if record is None:
+                return
+            record['holders'] = [pid for pid in record['holders'] if pid != os.getpid()]
+            record['lastUsed'] = time.time()
+            # The timeout of the last command using the session applies
+            record['timeout'] = session.SESSION_TIMEOUT
+            close_now = session.SESSION_TIMEOUT <= 0 and not record['holders']
+            if not close_now and table.reaper is None:
+                table.reaper = start_reaper()
+        if not close_now:
+            return
+        if can_sudo():
+            # Packed/unmounted by a child, the next command on the image waits for its lock
+            start_job('close', self.mount_point, self.image_file,
+                      lambda: close_idle_session(self.mount_point))
         else:
-            # Try to umount and ignore any errors
-            subprocess.Popen('sudo umount -R -l {}'.format(self.mount_point).split())
+            close_idle_session(self.mount_point)
         logger.debug('Clean/Unmount {}'.format(self.mount_point))
+
+
+# ================ Sessions ================
+def image_mount_point(image):
+    """Return the folder in ROOTFS_DIR the image (the partition of an MBR image) is mounted onto."""
+    return os.path.join(ROOTFS_DIR, session.image_key(image))
+
+
+def image_lock(mount_point):
+    # Mount points are named after the key of their images
+    return session.ImageLock(os.path.basename(mount_point))
+
+
+def image_fingerprint(path):
+    return catalog.image_fingerprint(os.stat(path))
+
+
+def close_session(mount_point, record):
+    """Write a session back to its image and unmount it."""
+    if record['type'] == 'CPIO':
+        if record.get('readOnly'):
+            logger.debug('{} is not changed by read-only commands'.format(record['image']))
+        elif not os.path.isfile(record['image']):
+            logger.warning('{} is gone, drop the files unpacked in {}'.format(record['image'],
+                                                                               mount_point))
+        elif record['fingerprint'] != image_fingerprint(record['image']):
+            # Packing the folder would overwrite what was written to the image meanwhile
+            logger.error('{} was written since it was unpacked, drop the changes in {}'.format(
+                record['image'], mount_point))
+        else:
+            repack_changed_cpio(mount_point, record['image'], record.get('treeState'))
+        safely_clean_dir(mount_point)
+    else:
+        try_unmount(mount_point)
+    try:
+        os.rmdir(mount_point)
+    except OSError:
+        pass
+
+
+def close_idle_session(mount_point, expired_only=False):
+    """Close the session on mount_point unless a command uses it. Return True when closed.
+
+    With expired_only, the session is only closed once it is idle for its timeout.
+    """
+    with image_lock(mount_point):
+        with session.SessionTable() as table:
+            record = table.sessions.get(mount_point)
+            if record is None or record['holders']:
+                return False
+            if expired_only and session.deadline(record) > time.time():
+                return False
+        close_session(mount_point, record)
+        with session.SessionTable() as table:
+            table.sessions.pop(mount_point, None)
+    return True
+
+
+def flush_sessions(image_path=None):
+    """Close the sessions (of image_path) no command uses. Return the images of the closed."""
+    with session.SessionTable() as table:
+        for record in table.sessions.values():
+            if record['holders'] and session.same_image(image_path, record['image']):
+                logger.warning('{} is still used by PID {}'.format(
+                    record['image'], ' '.join(map(str, record['holders']))))
+        idle = table.idle_sessions(image_path)
+    return [record['image'] for mount_point, record in idle if close_idle_session(mount_point)]
+
+
+def start_job(action, folder, image_path, work):
+    """Run work() in a child process recorded as a job on folder. Return the PID of the child."""
+    folder = os.path.realpath(folder)
+    # Recorded before the child can end and mark the job
+    with session.SessionTable() as table:
+        pid = os.fork()
+        if pid == 0:
+            # The lock stays held by the parent until the job is recorded
+            table.lock_file.close()
+            run_job(folder, work)
+        table.jobs[folder] = session.make_job(action, pid, image_path)
+    return pid
+
+
+def run_job(folder, work):
+    """Run work() as the job on folder in this child process, mark how it ended and exit."""
+    # Out of Ctrl-C and hang-ups of the terminal, which the parent has returned to
+    os.setpgrp()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    code = 0
+    try:
+        work()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception as e:
+        logger.error('Job on {} failed: {}'.format(folder, e))
+        code = 1
+    try:
+        with session.SessionTable() as table:
+            job = table.jobs.get(folder)
+            if job is not None and job['pid'] == os.getpid():
+                job['state'] = 'failed' if code else 'done'
+                job['ended'] = time.time()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Never return into the command of the parent
+        os._exit(code)
+
+
+def start_reaper():
+    """Start a process closing the sessions once they are idle. Return its PID."""
+    # The same script as this command, it reads the settings.sh next to it
+    command = [sys.executable, os.path.abspath(sys.argv[0]), 'flush', '--idle']
+    # A process group of its own keeps it out of Ctrl-C, the terminal is kept for sudo
+    reaper = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, preexec_fn=os.setpgrp)
+    return reaper.pid
+
+
+def can_sudo():
+    # The reaper runs in the background, it must never wait for a password
+    return subprocess.call(['sudo', '-n', 'true'], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def reap_idle_sessions():
+    """Close each session once it is idle for its timeout, until no session is left."""
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    while True:
+        with session.SessionTable() as table:
+            if table.reaper != os.getpid():
+                # Replaced by another reaper
+                return
+            if not table.sessions:
+                table.reaper = None
+                return
+            now = time.time()
+            expired = [mount_point for mount_point, record in table.idle_sessions()
+                       if session.deadline(record) <= now]
+            if expired and not can_sudo():
+                # Left to the next command or "flush"
+                table.reaper = None
+                return
+            # Sessions in use are idle from now at the earliest
+            deadlines = [now + record.get('timeout', session.SESSION_TIMEOUT)
+                         if record['holders'] else session.deadline(record)
+                         for record in table.sessions.values()]
+        # Closed without the lock of the records, commands on other images go on meanwhile
+        for mount_point in expired:
+            close_idle_session(mount_point, expired_only=True)
+        if not expired:
+            # Wake up regularly, sessions could be used again with another timeout meanwhile
+            time.sleep(min(max(min(deadlines) - now, 1), REAPER_INTERVAL))
@@ -0,0 +1,136 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file maps (a partition of) an image file in memory for the readers of
+# file systems in fsReader (extfs, fat and cpio).
+# A PartitionView is a read-only window on the mapping: reads are checked
+# against the bounds of the partition and return memoryview slices of the
+# mapping, so nothing is copied until the data is written somewhere. Views
+# made by slice() share the mapping of their parent.
+# The page cache is told what is read next (readahead) with madvise, where
+# Python supports it (3.8+).
+
+# Python buildin modules
+import os
+import mmap
+import errno
+import struct
+
+# Size of the chunks of iter_chunks
+CHUNK_SIZE = 1 << 20
+
+
+def find_partition(table, number):
+    """Return the partition numbered number in a partition table of imageParser, or None."""
+    parts = [p for p in table['partitions'] if p['number'] == number]
+    return parts[0] if parts else None
+
+
+class PartitionView():
+    """A bounds checked, read-only window of size bytes at offset in buf."""
+    def __init__(self, buf, offset=0, size=None, mapping=None):
+        whole = memoryview(buf)
+        if size is None:
+            size = len(whole) - offset
+        if offset < 0 or size < 0 or offset + size > len(whole):
+            whole.release()
+            raise OSError(errno.EINVAL, 'Partition out of the bounds of the image')
+        self.view = whole[offset:offset + size]
+        whole.release()
+        # The mmap holding buf, used for hints to the page cache, and the position of the view in it
+        self.mapping = mapping
+        self.mapping_offset = offset
+        self.owner = False
+
+    @classmethod
+    def map_file(cls, f, offset=0, size=None):
+        """Map size bytes at offset in the file f. Closing the view unmaps them."""
+        file_size = os.fstat(f.fileno()).st_size
+        # As with a loop device, a partition larger than the image ends with the image
+        size = file_size - offset if size is None else min(size, file_size - offset)
+        if offset < 0 or size <= 0:
+            raise OSError(errno.EINVAL, 'Partition out of the bounds of the image')
+        # Only the partition is mapped, from the allocation granularity before it
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(f.fileno(), offset + size - start, access=mmap.ACCESS_READ,
+                            offset=start)
+        view = cls(mapping, offset - start, size, mapping)
+        view.owner = True
+        return view
+
+    def slice(self, offset, size=None):
+        """Return a view of size bytes at offset in this view, sharing its mapping."""
+        view = PartitionView(self.view, offset, size, self.mapping)
+        view.mapping_offset += self.mapping_offset
+        return view
+
+    def __len__(self):
+        return len(self.view)
+
+    def check_range(self, offset, size):
+        if offset < 0 or size < 0 or offset + size > len(self.view):
+            raise OSError(errno.EIO, 'Read of {} bytes at {} is beyond the end of the partition'
+                          .format(size, offset))
+
+    # ================ Reads ================
+    def pread(self, offset, size):
+        """Return size bytes at offset as a memoryview of the mapping, no data is copied."""
+        self.check_range(offset, size)
+        return self.view[offset:offset + size]
+
+    def unpack(self, struct_format, offset):
+        """Unpack a struct.Struct or a format string at offset."""
+        if not isinstance(struct_format, struct.Struct):
+            struct_format = struct.Struct(struct_format)
+        self.check_range(offset, struct_format.size)
+        return struct_format.unpack_from(self.view, offset)
+
+    def iter_chunks(self, offset=0, size=None, chunk_size=CHUNK_SIZE):
+        """Yield the content of the view in chunks, e.g. for hashing or comparing partitions."""
+        if size is None:
+            size = len(self.view) - offset
+        self.check_range(offset, size)
+        end = offset + size
+        self.readahead(offset, min(chunk_size, size))
+        for position in range(offset, end, chunk_size):
+            length = min(chunk_size, end - position)
+            # Ask for the next chunk while this one is consumed
+            self.readahead(position + length, min(chunk_size, end - position - length))
+            yield self.view[position:position + length]
+
+    # ================ Hints to the page cache ================
+    def advise(self, option, offset=0, size=None):
+        """madvise the pages of a range of the view, a no-op when it is not supported."""
+        if self.mapping is None or not hasattr(self.mapping, 'madvise'):
+            return
+        if size is None:
+            size = len(self.view) - offset
+        offset, size = max(offset, 0), min(size, len(self.view) - offset)
+        if size <= 0:
+            return
+        start = self.mapping_offset + offset
+        # madvise works on whole pages
+        aligned = start - start % mmap.PAGESIZE
+        try:
+            self.mapping.madvise(option, aligned, start + size - aligned)
+        except (OSError, ValueError):
+            pass
+
+    def readahead(self, offset=0, size=None):
+        """Start reading a range of the view into the page cache, without waiting for it."""
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self.advise(mmap.MADV_WILLNEED, offset, size)
+
+    def close(self):
+        self.view.release()
+        if self.owner and not self.mapping.closed:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # Chunks are still referenced, the mapping is closed with the last of them
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
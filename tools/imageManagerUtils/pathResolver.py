@@ -0,0 +1,49 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file resolves paths inside an image for the readers of fsReader (extfs,
+# cpio and the manifests), following symbolic links as the kernel does.
+# Readers give the walk two functions on their own nodes, e.g. inodes or paths
+# in an archive:
+#   lookup(folder, name) -> (node, mode) of the entry name in folder, or None
+#   read_link(node) -> target of a symbolic link
+# "." and ".." are handled here, the root is its own parent.
+
+# Python buildin modules
+import stat
+import errno
+
+# Same limit as the kernel when following symbolic links
+MAX_SYMLINKS = 40
+
+
+def resolve(path, root, lookup, read_link, follow_symlinks=True):
+    """Return the node of path, relative to the folder root. Errors are raised as OSError."""
+    # Folders from the root to the current one, with their modes
+    folders = [(root, stat.S_IFDIR)]
+    pending = [name for name in reversed(path.split('/')) if name]
+    links = 0
+    while pending:
+        name = pending.pop()
+        if name == '.':
+            continue
+        if name == '..':
+            if len(folders) > 1:
+                folders.pop()
+            continue
+        folder, mode = folders[-1]
+        if not stat.S_ISDIR(mode):
+            raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+        child = lookup(folder, name)
+        if child is None:
+            raise FileNotFoundError(errno.ENOENT, 'No such file or directory', path)
+        if stat.S_ISLNK(child[1]) and (follow_symlinks or pending):
+            links += 1
+            if links > MAX_SYMLINKS:
+                raise OSError(errno.ELOOP, 'Too many levels of symbolic links', path)
+            target = read_link(child[0])
+            if target.startswith('/'):
+                del folders[1:]
+            pending.extend(name for name in reversed(target.split('/')) if name)
+            continue
+        folders.append(child)
+    return folders[-1][0]
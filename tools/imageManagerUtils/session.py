@@ -0,0 +1,214 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file keeps the records of the images kept mounted (or unpacked, for
+# CPIO images) by AutoMount across commands, see mount.py.
+# Mounting an image for every command, and unpacking and packing a CPIO image
+# again each time, costs far more than most commands. A session is opened by
+# the first command on an image and reused by the following ones on the same
+# image. The records are kept in .cache/sessions.json, guarded by a lock file:
+# the mount point, the image, the PIDs of the commands using the session (its
+# refcount) and when it was last used.
+# A session nobody uses is closed after IMAGE_SESSION_TIMEOUT seconds (60 by
+# default, 0 closes it as soon as the command ends) by a background process,
+# or at once by "imageManager.py flush".
+# Each image (each partition of an MBR image) has a mount point of its own, so
+# commands on different images run in parallel. Opening and closing the session
+# of an image is guarded by a lock of the image, taken before the lock of the
+# records and never the other way round.
+# Work left to a child process so that the command returns at once, e.g. closing
+# a session or "mount -F", is recorded as a job with its PID and state next to
+# the sessions. "imageManager.py wait" blocks until the jobs end.
+
+# Python buildin modules
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging as logger
+
+# Utils designed for this script
+from . import catalog
+
+SESSIONS_PATH = os.path.join(catalog.CACHE_DIR, 'sessions.json')
+LOCK_PATH = os.path.join(catalog.CACHE_DIR, 'sessions.lock')
+# Seconds between two checks of the running jobs while waiting for them
+JOB_POLL_INTERVAL = 0.1
+# Lock files of the images, named after their image_key as their mount points
+IMAGE_LOCK_DIR = os.path.join(catalog.CACHE_DIR, 'locks')
+DEFAULT_SESSION_TIMEOUT = 60
+
+
+def read_session_timeout():
+    value = os.environ.get('IMAGE_SESSION_TIMEOUT', DEFAULT_SESSION_TIMEOUT)
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning('IMAGE_SESSION_TIMEOUT is not a number of seconds: "{}", use {}'.format(
+            value, DEFAULT_SESSION_TIMEOUT))
+        return DEFAULT_SESSION_TIMEOUT
+
+
+# Seconds a session is kept after its last use, set in settings.sh or the environment
+SESSION_TIMEOUT = read_session_timeout()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user, e.g. root
+        pass
+    return True
+
+
+def read_sessions():
+    try:
+        with open(SESSIONS_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def make_record(image, fingerprint, read_only=False, tree_state=None):
+    return {
+        'image': image['path'],
+        'type': image['type'],
+        'partition': image.get('targetPartition'),
+        # Image files of CPIO sessions are only written when the session is closed
+        'fingerprint': fingerprint,
+        # Opened by read-only commands, the image is the same as the session
+        'readOnly': read_only,
+        # Digest of the CPIO tree just unpacked, it is not packed again unless it changes
+        'treeState': tree_state,
+        'holders': [],
+        'lastUsed': time.time(),
+        'timeout': SESSION_TIMEOUT,
+    }
+
+
+def image_key(image):
+    """Return the name of the mount point and of the lock of the image (the partition of MBR)."""
+    # Named after the path, which stays the same while the image is written unlike its fingerprint
+    path = os.path.realpath(image['path'])
+    key = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    if image['type'] == 'MBR':
+        key = '{}-p{}'.format(key, image.get('targetPartition'))
+    return key
+
+
+def same_image(image_path, record_image):
+    """Return whether the paths name the same image file, e.g. through a symlink. None is any."""
+    return image_path is None or os.path.realpath(image_path) == os.path.realpath(record_image)
+
+
+def make_job(action, pid, image_path):
+    return {
+        'action': action,
+        'pid': pid,
+        'image': image_path,
+        # running, done or failed
+        'state': 'running',
+        'started': time.time(),
+    }
+
+
+def deadline(record):
+    """Return when an idle session expires."""
+    return record['lastUsed'] + record.get('timeout', SESSION_TIMEOUT)
+
+
+def find(image_path, writable=False):
+    """Return the record of an open session of image_path, or None. Read without the lock.
+
+    With writable, the sessions opened read-only are skipped, the image is up to date with them.
+    """
+    for record in read_sessions().get('sessions', {}).values():
+        if same_image(image_path, record['image']) and not (writable and record.get('readOnly')):
+            return record
+    return None
+
+
+class SessionTable():
+    """The records of the sessions by mount point, locked against other commands while open."""
+    def __enter__(self):
+        os.makedirs(catalog.CACHE_DIR, exist_ok=True)
+        self.lock_file = open(LOCK_PATH, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        data = read_sessions()
+        self.sessions = data.get('sessions', {})
+        # PID of the process closing idle sessions
+        self.reaper = data.get('reaper')
+        if self.reaper is not None and not is_alive(self.reaper):
+            self.reaper = None
+        for record in self.sessions.values():
+            # Forget commands which ended without releasing their sessions, e.g. killed
+            record['holders'] = [pid for pid in record['holders'] if is_alive(pid)]
+        # Jobs by the folder they work on
+        self.jobs = data.get('jobs', {})
+        # Digests of the CPIO trees unpacked by "mount" by folder, checked by "umount"
+        self.trees = data.get('trees', {})
+        for job in self.jobs.values():
+            if job['state'] == 'running' and not is_alive(job['pid']):
+                # Killed before it could tell how it ended
+                job['state'] = 'failed'
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            catalog.write_json(SESSIONS_PATH, {'sessions': self.sessions, 'reaper': self.reaper,
+                                               'jobs': self.jobs, 'trees': self.trees})
+        finally:
+            # Closing the file releases the lock
+            self.lock_file.close()
+
+    def idle_sessions(self, image_path=None):
+        """Return (mount point, record) of the sessions used by no command."""
+        return [(mount_point, record) for mount_point, record in self.sessions.items()
+                if not record['holders'] and same_image(image_path, record['image'])]
+
+    def select_jobs(self, image_path=None, mount_point=None):
+        """Return the jobs (of image_path, on mount_point) by the folder they work on."""
+        return {folder: job for folder, job in self.jobs.items()
+                if same_image(image_path, job['image']) and mount_point in [None, folder]}
+
+
+def wait_jobs(image_path=None, mount_point=None, forget_failed=False):
+    """Block until the jobs (of image_path, on mount_point) end. Return the failed ones.
+
+    The jobs which are done are forgotten, the failed ones are kept to be reported by "wait"
+    unless forget_failed.
+    """
+    while True:
+        with SessionTable() as table:
+            jobs = table.select_jobs(image_path, mount_point)
+            running = [job for job in jobs.values() if job['state'] == 'running']
+            for job in running:
+                try:
+                    # Children of this process would stay zombies, alive to kill(), until reaped
+                    os.waitpid(job['pid'], os.WNOHANG)
+                except ChildProcessError:
+                    pass
+            if not running:
+                for folder, job in jobs.items():
+                    if job['state'] == 'done' or forget_failed:
+                        del table.jobs[folder]
+                return [job for job in jobs.values() if job['state'] == 'failed']
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+class ImageLock():
+    """Hold the lock of an image, by its image_key, while opening, closing or writing it."""
+    def __init__(self, key):
+        self.path = os.path.join(IMAGE_LOCK_DIR, key + '.lock')
+
+    def __enter__(self):
+        os.makedirs(IMAGE_LOCK_DIR, exist_ok=True)
+        self.lock_file = open(self.path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.lock_file.close()
@@ -6,10 +6,21 @@
 # run the target bash scripts and call "env".
 # By processing the standard output from the result, we can parse the
 # deduced (interpreted) values and update the current (Python) context.
+#
+# Running bash costs far more than the rest of the startup, so the deduced
+# values are cached next to settings.sh. The cache is keyed on the content of
+# settings.sh, AXIOM_HOME (the folder holding it) and the environment bash is run
+# with: PATH, HOME and the variables expanded by settings.sh, e.g. IMAGE_DIR.
+# Bash is only run again when any of them changes.
 
 import os
+import re
 import sys
-import subprocess
+import json
+import time
+import hashlib
+
+START_TIME = time.perf_counter()
 
 # This path is the location of the caller script
 MAIN_SCRIPT_PATH = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -18,14 +29,96 @@ settings_path = os.path.join(MAIN_SCRIPT_PATH, 'settings.sh')
 if not os.path.isfile(settings_path):
     print('Cannot find settings.sh in ' + MAIN_SCRIPT_PATH)
     exit(1)
-# This is a tricky way to read bash envs in the script
-env_str = subprocess.check_output(
-    'source {} && env'.format(settings_path), shell=True, executable='/bin/bash')
-# Transform to list of python strings (utf-8 encodings)
-env_str = env_str.decode('utf-8').split('\n')
-# Transform from a list to a list of pairs and filter out invalid formats
-env_list = [kv.split('=') for kv in env_str if len(kv.split('=')) == 2]
-# Transform from a list to a dictionary
-env_dict = {kv[0]: kv[1] for kv in env_list}
+cache_path = os.path.join(MAIN_SCRIPT_PATH, '.settings.sh.cache')
+# Expansions of variables in settings.sh, e.g. "$HOME" or "${IMAGE_DIR:-...}"
+VARIABLE_PATTERN = re.compile(rb'\$\{?[#!]?([A-Za-z_][A-Za-z0-9_]*)')
+# Passed to bash besides the variables expanded by settings.sh, to run commands
+BASE_VARIABLES = ['PATH', 'HOME']
+# Maintained by bash itself, they are not settings
+BASH_VARIABLES = ['_', 'SHLVL']
+
+
+def read_settings():
+    with open(settings_path, 'rb') as f:
+        return f.read()
+
+
+def settings_env(content):
+    """Return the environment settings.sh is sourced in, all of it is in the cache key."""
+    names = set(name.decode('ascii') for name in VARIABLE_PATTERN.findall(content))
+    return {k: os.environ[k] for k in sorted(names.union(BASE_VARIABLES)) if k in os.environ}
+
+
+def source_settings(env):
+    # Imported here since it is only needed when the cache misses
+    import subprocess
+    # This is a tricky way to read bash envs in the script.
+    # Print the environment before and after sourcing, separated by an empty NUL entry,
+    # so that the variables set up by bash itself are left out. Bash reads ~/.bashrc when stdin
+    # is a socket, e.g. over ssh, and must not take the input of the command anyway.
+    env_str = subprocess.check_output(
+        ['/bin/bash', '-c', 'env -0 && printf "\\0" && source "$1" > /dev/null && env -0',
+         'bash', settings_path], env=env, stdin=subprocess.DEVNULL)
+    # Transform to list of python strings, undecodable bytes are kept as os.environ does
+    env_list = env_str.decode('utf-8', 'surrogateescape').split('\0')
+    separator = env_list.index('')
+    # Split on the first '=' only, values are allowed to contain '='
+    before = dict(kv.partition('=')[::2] for kv in env_list[:separator])
+    after = dict(kv.partition('=')[::2] for kv in env_list[separator + 1:] if kv)
+    for k in BASH_VARIABLES:
+        after.pop(k, None)
+    # The variables of env are kept even when settings.sh sets them to the values they had,
+    # the cache must not depend on the caller having them
+    return {k: v for k, v in after.items() if k in env or before.get(k) != v}
+
+
+def settings_key(content, env):
+    axiom_home = os.path.realpath(MAIN_SCRIPT_PATH)
+    env_values = json.dumps(env, sort_keys=True)
+    return hashlib.sha256(b'\0'.join([content, axiom_home.encode('utf-8'),
+                                       env_values.encode('utf-8')])).hexdigest()
+
+
+def load_cached_settings(key):
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('key') != key:
+        return None
+    return cache.get('env')
+
+
+def save_cached_settings(key, env_dict):
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'env': env_dict}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # The cache is an optimization only, e.g. AXIOM_HOME could be read-only
+        pass
+
+
+def print_startup_timing():
+    start = time.perf_counter()
+    source_settings(settings_env(read_settings()))
+    bash_time = time.perf_counter() - start
+    print('settings.sh cache : {}'.format('hit' if CACHE_HIT else 'miss'))
+    print('Load settings     : {:8.3f} ms'.format(LOAD_TIME * 1000))
+    print('Source with bash  : {:8.3f} ms'.format(bash_time * 1000))
+    print('Saved per startup : {:8.3f} ms'.format((bash_time - LOAD_TIME) * 1000))
+
+
+content = read_settings()
+base_env = settings_env(content)
+key = settings_key(content, base_env)
+env_dict = load_cached_settings(key)
+CACHE_HIT = env_dict is not None
+if not CACHE_HIT:
+    env_dict = source_settings(base_env)
+    save_cached_settings(key, env_dict)
 # Update the os.environ globally
 os.environ.update(env_dict)
+LOAD_TIME = time.perf_counter() - START_TIME
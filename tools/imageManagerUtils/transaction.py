@@ -0,0 +1,133 @@
+# Copyright (c) 2017, MIT Licensed, Medicine Yeh
+
+# This file reads the operations run by "imageManager.py apply" on an image,
+# all of them in one mount of the image, which is written back once at the end.
+# The operations are listed in a file, or stdin when the file is "-", in one of
+# these formats:
+#   Lines (default): one operation per line, words split as by a shell, "#"
+#                    starts a comment
+#       mkdir -p /etc/init.d
+#       push ./rcS /etc/init.d
+#   JSON (.json or starting with "["): a list of operations, each one a list
+#                    of words or a line as above
+#       [["mkdir", "-p", "/etc/init.d"], "push ./rcS /etc/init.d"]
+#   YAML (.yaml, .yml): the same list as JSON, needs PyYAML
+# The operations are:
+#   push <HOST PATH> <PATH>, pull <PATH> <HOST PATH>, rm [OPTIONS] <PATH>...,
+#   mkdir [OPTIONS] <PATH>..., chmod [-R] <MODE> <PATH>..., symlink <TARGET> <PATH>
+# where <PATH> is a path in the image relative to the folder given to apply.
+
+# Python buildin modules
+import os
+import sys
+import json
+import shlex
+
+# Number of paths (or host paths, modes and targets) taken by each operation, None for any
+OPERATIONS = {
+    'push': 2,
+    'pull': 2,
+    'rm': None,
+    'mkdir': None,
+    'chmod': None,
+    'symlink': 2,
+}
+# Options passed to the commands run by the operations
+OPTION_OPERATIONS = ['rm', 'mkdir']
+CHMOD_OPTIONS = ['-R', '--recursive']
+
+
+def split_options(name, words):
+    """Return the leading options of an operation and the rest of its arguments."""
+    count = 0
+    for word in words:
+        if name in OPTION_OPERATIONS and word.startswith('-'):
+            count += 1
+        elif name == 'chmod' and word in CHMOD_OPTIONS:
+            count += 1
+        else:
+            break
+    return words[:count], words[count:]
+
+
+def make_operation(where, words):
+    if not words:
+        return None
+    name = words[0]
+    if name not in OPERATIONS:
+        raise ValueError('{}: unknown operation "{}"'.format(where, name))
+    options, args = split_options(name, words[1:])
+    minimum = 2 if name == 'chmod' else 1
+    if OPERATIONS[name] is not None and len(args) != OPERATIONS[name]:
+        raise ValueError('{}: {} takes {} arguments'.format(where, name, OPERATIONS[name]))
+    if len(args) < minimum:
+        raise ValueError('{}: {} needs a path'.format(where, name))
+    return {'where': where, 'name': name, 'options': options, 'args': args, 'words': words}
+
+
+def parse_entries(entries, source):
+    if not isinstance(entries, list):
+        raise ValueError('{}: expect a list of operations'.format(source))
+    operations = []
+    for i, entry in enumerate(entries, 1):
+        where = '{} entry {}'.format(source, i)
+        if isinstance(entry, str):
+            words = shlex.split(entry, comments=True)
+        elif isinstance(entry, list) and all(isinstance(word, str) for word in entry):
+            words = entry
+        else:
+            raise ValueError('{}: expect a list of words or a line'.format(where))
+        operation = make_operation(where, words)
+        if operation is not None:
+            operations.append(operation)
+    return operations
+
+
+def parse_lines(text, source):
+    operations = []
+    for i, line in enumerate(text.splitlines(), 1):
+        where = '{} line {}'.format(source, i)
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(where, e))
+        operation = make_operation(where, words)
+        if operation is not None:
+            operations.append(operation)
+    return operations
+
+
+def load(path):
+    """Return the operations listed in the file at path, or stdin when path is "-".
+
+    Raise ValueError when an operation is malformed, none of them is run then.
+    """
+    if path == '-':
+        text, source = sys.stdin.read(), 'stdin'
+    else:
+        with open(path, 'r') as f:
+            text, source = f.read(), path
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.yaml', '.yml']:
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('PyYAML is needed to read {}'.format(path))
+        try:
+            return parse_entries(yaml.safe_load(text), source)
+        except yaml.YAMLError as e:
+            raise ValueError('{}: {}'.format(source, e))
+    if extension == '.json' or text.lstrip().startswith('['):
+        try:
+            return parse_entries(json.loads(text), source)
+        except json.JSONDecodeError as e:
+            raise ValueError('{}: {}'.format(source, e))
+    return parse_lines(text, source)
+
+
+def resolve(mount_point, base, path):
+    """Return the path on the host of path in the image, relative to base in mount_point."""
+    host_path = os.path.normpath(os.path.join(base, path.lstrip('/')))
+    if host_path != mount_point and not host_path.startswith(mount_point + os.sep):
+        raise ValueError('{} is out of the image'.format(path))
+    return host_path